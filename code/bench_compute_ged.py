@@ -0,0 +1,33 @@
+# %%
+""" Benchmark: generalized eigenvalue solvers of ssd.compute_ged for
+different numbers of channels."""
+import timeit
+import numpy as np
+import ssd
+
+np.random.seed(22)
+nr_samples = 20000
+nr_repeats = 5
+
+# %% compare general and symmetric solver
+print(f"{'channels':>8} {'eig [ms]':>10} {'eigh [ms]':>10} "
+      f"{'eigh, 4 [ms]':>13} {'speedup':>8}")
+
+for nr_channels in [32, 64, 128, 256]:
+
+    # covariance matrices of mixed signal and noise sources
+    mixing = np.random.randn(nr_channels, nr_channels)
+    signal = mixing @ np.random.randn(nr_channels, nr_samples)
+    noise = np.random.randn(nr_channels, nr_samples)
+    cov_signal = np.cov(signal)
+    cov_noise = np.cov(signal + noise)
+
+    durations = []
+    for solver, n_components in [('eig', None), ('eigh', None),
+                                 ('eigh', 4)]:
+        timer = timeit.Timer(lambda: ssd.compute_ged(
+            cov_signal, cov_noise, solver=solver, n_components=n_components))
+        durations.append(1000 * min(timer.repeat(nr_repeats, number=1)))
+
+    print(f"{nr_channels:>8} {durations[0]:>10.1f} {durations[1]:>10.1f} "
+          f"{durations[2]:>13.1f} {durations[0] / durations[2]:>7.1f}x")
@@ -0,0 +1,239 @@
+""" Benchmark: duration and peak memory of the processing hot paths.
+
+Synthetic LEMON-like recordings (62 channels, 2500 Hz, several minutes) are
+simulated from power-law noise and alpha-band sinusoids with a harmonic, as
+in fig1a and fig2a. Processing steps are timed (best of several repeats)
+and their peak memory is measured in a separate run with tracemalloc.
+Results are appended to a json-lines file in BENCHMARK_DIR together with
+the current commit, so they can be compared across commits and channel
+counts.
+
+Usage: python bench_pipeline.py [--channels N ...] [--seconds S]
+                                [--repeats R] [--compare COMMIT]
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import datetime
+import subprocess
+import tracemalloc
+
+import numpy as np
+import mne
+import neurodsp.sim
+
+from params import BENCHMARK_DIR, SSD_WIDTH, SPEC_NR_SECONDS
+import ssd
+import helper
+import raw_mmap
+import results_store
+import spectral_cache
+import proc1_sensor_alpha_frequency as proc1
+import proc2_compute_ssd as proc2
+import proc3_spec_param_on_ssd as proc3
+
+mne.set_log_level(verbose=False)
+
+BENCHMARK_FILE = f"{BENCHMARK_DIR}/benchmarks.jsonl"
+SUBJECT = 'sub-benchmark'
+CONDITION = 'eo'
+
+
+def simulate_raw(nr_channels=62, sfreq=2500, nr_seconds=180, seed=22):
+    """Simulate a recording with alpha sources, harmonics and 1/f noise."""
+
+    np.random.seed(seed)
+    nr_samples = int(nr_seconds * sfreq)
+    time_points = np.arange(nr_samples) / sfreq
+
+    # few oscillatory sources, each with a non-sinusoidal alpha rhythm
+    sources = []
+    for freq in [9.5, 10.5, 11.0]:
+        powerlaw = neurodsp.sim.sim_powerlaw(n_seconds=nr_seconds, fs=sfreq,
+                                             exponent=-1.5)
+        alpha = np.sin(2 * np.pi * freq * time_points)
+        beta = 0.25 * np.sin(2 * np.pi * 2 * freq * time_points)
+        sources.append(powerlaw * (alpha + beta))
+    for i_source in range(5):
+        sources.append(neurodsp.sim.sim_powerlaw(n_seconds=nr_seconds,
+                                                 fs=sfreq, exponent=-2))
+    sources = np.array(sources)[:, :nr_samples]
+
+    mixing = np.random.randn(nr_channels, len(sources))
+    noise = np.random.randn(nr_channels, nr_samples)
+    data = 1e-6 * (mixing @ sources + 0.5 * noise)
+
+    # positions of the 10-20 system, as used for the LEMON data in proc2
+    montage = mne.channels.make_standard_montage('standard_1020')
+    ch_names = [ch for ch in montage.ch_names if ch[-1] == 'z'] + \
+        [ch for ch in montage.ch_names if ch[-1] != 'z']
+    info = mne.create_info(ch_names[:nr_channels], sfreq, 'eeg')
+    raw = mne.io.RawArray(data, info)
+    raw.set_montage(montage)
+
+    return raw
+
+
+def use_scratch_folder(folder):
+    """Direct data, results and caches of the processing steps to folder."""
+
+    raw_mmap.DATA_DIR = folder
+    raw_mmap.MMAP_DIR = folder
+    proc1.DATA_DIR = folder
+    proc2.SSD_DIR = folder
+    proc3.SSD_DIR = folder
+    results_store.RESULTS_DB = f"{folder}/results.sqlite"
+    spectral_cache.CACHE_DIR = f"{folder}/cache/"
+    spectral_cache.DIGESTS_FILE = f"{folder}/cache/file_digests.json"
+
+
+def get_benchmarks(raw):
+    """Return the benchmarks as dict of name: (function, setup)."""
+
+    peak = 10.5
+    signal_bp, noise_bp, noise_bs = ssd.get_bands(peak, SSD_WIDTH)
+    filters, _ = ssd.compute_ssd(raw, signal_bp, noise_bp, noise_bs)
+    cov_signal = np.cov(np.diff(raw._data[:, :60000]))
+    cov_noise = np.cov(raw._data[:, :60000])
+
+    def clear_cache():
+        shutil.rmtree(spectral_cache.CACHE_DIR, ignore_errors=True)
+
+    return {
+        'percentile_spectrum': (lambda: helper.percentile_spectrum(
+            raw, band=(8, 13), nr_seconds=SPEC_NR_SECONDS), None),
+        'compute_ssd': (lambda: ssd.compute_ssd(
+            raw, signal_bp, noise_bp, noise_bs), None),
+        'compute_ssd_mmap': (lambda: ssd.compute_ssd(
+            raw_mmap.read_raw_mmap(SUBJECT, CONDITION), signal_bp,
+            noise_bp, noise_bs), None),
+        'compute_ged': (lambda: ssd.compute_ged(cov_signal, cov_noise),
+                        None),
+        'apply_filters': (lambda: ssd.apply_filters(raw, filters[:, :4]),
+                          None),
+        'proc1': (lambda: proc1.process_1sub(SUBJECT, CONDITION),
+                  clear_cache),
+        'proc2': (lambda: proc2.process_1sub(SUBJECT, CONDITION), None),
+        'proc3': (lambda: proc3.process_1sub(SUBJECT, CONDITION), None),
+    }
+
+
+def measure(func, setup=None, nr_repeats=3):
+    """Best duration in seconds and peak memory in MB of a function."""
+
+    durations = []
+    for i_repeat in range(nr_repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(durations), peak_memory / 1e6
+
+
+def get_commit():
+    """Current commit, marked if the working tree has changes."""
+
+    def git(*args):
+        return subprocess.run(['git', *args], capture_output=True,
+                              text=True).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    if git('status', '--porcelain', '--untracked-files=no'):
+        commit += '+'
+    return commit
+
+
+def load_results():
+    if not os.path.exists(BENCHMARK_FILE):
+        return []
+    with open(BENCHMARK_FILE) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(results, reference):
+    """Print the current results next to those of a reference commit."""
+
+    previous = {(result['benchmark'], result['nr_channels'],
+                 result['nr_seconds']): result for result in load_results()
+                if result['commit'] == reference}
+
+    print(f"\ncompared to {reference}")
+    print(f"{'benchmark':>20} {'channels':>8} {'duration':>9} "
+          f"{'ratio':>6} {'memory':>9} {'ratio':>6}")
+    for result in results:
+        ref = previous.get((result['benchmark'], result['nr_channels'],
+                            result['nr_seconds']))
+        if ref is None:
+            continue
+        print(f"{result['benchmark']:>20} {result['nr_channels']:>8} "
+              f"{result['duration']:>8.3f}s "
+              f"{result['duration'] / ref['duration']:>6.2f} "
+              f"{result['peak_memory']:>7.1f}MB "
+              f"{result['peak_memory'] / max(ref['peak_memory'], 1e-6):>6.2f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', type=int, nargs='+', default=[62])
+    parser.add_argument('--seconds', type=float, default=180)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--compare', default=None,
+                        help="commit to compare with, default: the last "
+                             "other commit with results")
+    args = parser.parse_args()
+    max_channels = len(mne.channels.make_standard_montage(
+        'standard_1020').ch_names)
+    if max(args.channels) > max_channels:
+        parser.error(f"at most {max_channels} channels are supported")
+
+    commit = get_commit()
+    date = datetime.datetime.now().isoformat(timespec='seconds')
+    folder = tempfile.mkdtemp(prefix='bench_pipeline_')
+    use_scratch_folder(folder)
+
+    results = []
+    try:
+        for nr_channels in args.channels:
+            raw = simulate_raw(nr_channels, nr_seconds=args.seconds)
+            raw.save(f"{folder}/{SUBJECT}_{CONDITION}-raw.fif",
+                     overwrite=True)
+            raw_mmap.convert_to_mmap(SUBJECT, CONDITION)
+
+            print(f"{nr_channels} channels, {args.seconds} s")
+            benchmarks = get_benchmarks(raw)
+            for name, (func, setup) in benchmarks.items():
+                duration, peak_memory = measure(func, setup, args.repeats)
+                print(f"{name:>20} {duration:>8.3f}s {peak_memory:>8.1f}MB")
+                results.append(dict(
+                    benchmark=name, commit=commit, date=date,
+                    nr_channels=nr_channels, sfreq=raw.info['sfreq'],
+                    nr_seconds=args.seconds, duration=duration,
+                    peak_memory=peak_memory))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    reference = args.compare
+    if reference is None:
+        commits = [result['commit'] for result in load_results()
+                   if result['commit'] != commit]
+        reference = commits[-1] if commits else None
+    if reference is not None:
+        compare(results, reference)
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    with open(BENCHMARK_FILE, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
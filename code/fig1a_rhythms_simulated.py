@@ -4,7 +4,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 import neurodsp.sim
-from helper import despine
+from plotting import despine
 from params import FIG_DIR, SPEC_NR_SECONDS
 import matplotlib.ticker as mticker
 
@@ -2,7 +2,8 @@
 import matplotlib.pyplot as plt
 import mne
 from params import DATA_DIR, FIG_DIR, SPEC_NR_SECONDS
-from helper import despine
+from plotting import despine
+from spectral_cache import load_or_compute
 import ssd
 import matplotlib.ticker as mticker
 import numpy as np
@@ -30,8 +31,6 @@ for i_sub, subject in enumerate(subjects):
     band, peak, condition, i_comp, idx = data[subject]
 
     file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
-    raw = mne.io.read_raw_fif(file_name, preload=True)
-    raw.pick_types(eeg=True)
     peak_beta = data[subject][1]
     SSD_WIDTH = 3
 
@@ -39,19 +38,34 @@ for i_sub, subject in enumerate(subjects):
     noise_bp = [peak_beta - (SSD_WIDTH + 2), peak_beta + (SSD_WIDTH + 2)]
     noise_bp = [None, peak_beta + (SSD_WIDTH + 2)]
     noise_bs = [peak_beta - (SSD_WIDTH + 1), peak_beta + (SSD_WIDTH + 1)]
-    filters, patterns = ssd.compute_ssd(raw, signal_bp, noise_bp, noise_bs)
 
-    raw_ssd = ssd.apply_filters(raw, filters[:, :2])
+    length = 500
 
-    n_fft = int(SPEC_NR_SECONDS * raw.info['sfreq'])
-    psd, freq = mne.time_frequency.psd_welch(raw_ssd, fmin=1, fmax=45,
-                                             n_fft=n_fft)
+    def compute():
+        raw = mne.io.read_raw_fif(file_name, preload=True)
+        raw.pick_types(eeg=True)
+        filters, patterns = ssd.compute_ssd(raw, signal_bp, noise_bp,
+                                            noise_bs)
 
-    raw_ssd.filter(1, None)
+        raw_ssd = ssd.apply_filters(raw, filters[:, :2])
 
-    length = 500
-    signal = raw_ssd._data[i_comp][idx:idx + length]
-    ax[i_sub, 0].plot(raw.times[:length], signal, 'k', lw=0.85)
+        n_fft = int(SPEC_NR_SECONDS * raw.info['sfreq'])
+        psd, freq = mne.time_frequency.psd_welch(raw_ssd, fmin=1, fmax=45,
+                                                 n_fft=n_fft)
+
+        raw_ssd.filter(1, None)
+        signal = raw_ssd._data[i_comp][idx:idx + length]
+        return dict(psd=psd, freq=freq, signal=signal,
+                    times=raw.times[:length])
+
+    key = dict(subject=subject, condition=condition, signal_bp=signal_bp,
+               noise_bp=noise_bp, noise_bs=noise_bs, component=i_comp,
+               start=idx, length=length, nr_seconds=SPEC_NR_SECONDS)
+    results = load_or_compute('ssd_psd', key, compute, [file_name])
+    psd, freq = results['psd'], results['freq']
+    signal = results['signal']
+
+    ax[i_sub, 0].plot(results['times'], signal, 'k', lw=0.85)
     ax[i_sub, 0].set(xlim=(0.7, 1.3), xlabel='time [s]', yticks=[])
     ax[i_sub, 0].axis('off')
 
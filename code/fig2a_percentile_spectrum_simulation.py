@@ -3,7 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 import neurodsp.sim
-from helper import percentile_spectrum, despine
+from helper import percentile_spectrum
+from plotting import despine
 from params import BETA_FMIN, BETA_FMAX, FIG_WIDTH, FIG_DIR
 import matplotlib.ticker as mticker
 
@@ -3,60 +3,92 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mne
 from params import DATA_DIR, BETA_FMIN, BETA_FMAX, ALPHA_FMIN, \
-    ALPHA_FMAX, FIG_WIDTH, FIG_DIR, SPEC_NR_SECONDS, SPEC_NR_PEAKS
-from helper import percentile_spectrum, get_participant_list, despine
+    ALPHA_FMAX, FIG_WIDTH, FIG_DIR, SPEC_NR_SECONDS
+from helper import get_participant_list, fit_aperiodic, segment_spectra, \
+    sort_percentiles
+from plotting import despine
+from spectral_cache import load_or_compute
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 import matplotlib.gridspec as gridspec
-import scipy.stats
+import stats
 import matplotlib.ticker as mticker
-import fooof
 plt.rc('axes.formatter', useoffset=False)
 plt.style.use('figures.mplstyle')
 
 mne.set_log_level(verbose=False)
 
-# %% compute increase in alpha for each participant
 condition = 'eo'
+
+
+def c3_segment_spectra(subject):
+    """Segment PSDs of channel C3 (average reference), from the cache."""
+
+    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
+
+    def compute():
+        raw = mne.io.read_raw_fif(file_name, preload=True)
+        raw.set_eeg_reference('average')
+        raw.pick_channels(['C3'])
+        psd, freq = segment_spectra(raw, nr_seconds=SPEC_NR_SECONDS)
+        return dict(psd=psd, freq=freq)
+
+    key = dict(subject=subject, condition=condition, channels=['C3'],
+               reference='average', nr_seconds=SPEC_NR_SECONDS)
+    spectra = load_or_compute('segment_spectra', key, compute, [file_name])
+
+    return spectra['psd'], spectra['freq']
+
+
+def beta_pattern(subject):
+    """Beta-band pattern of a C3 spatial filter, from the cache."""
+
+    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
+
+    def compute():
+        raw = mne.io.read_raw_fif(file_name, preload=True)
+        raw.pick_types(eeg=True)
+        raw.set_eeg_reference('average')
+        idx = mne.pick_channels(raw.ch_names, ['C3'])
+        filter = np.zeros(len(raw.ch_names))
+        filter[idx] = 1
+        raw.filter(BETA_FMIN, BETA_FMAX)
+        cov = np.cov(raw._data)
+        return dict(pattern=filter @ cov)
+
+    key = dict(subject=subject, condition=condition, channels=['C3'],
+               reference='average', band=[BETA_FMIN, BETA_FMAX])
+    return load_or_compute('sensor_pattern', key, compute,
+                           [file_name])['pattern']
+
+
+# %% compute increase in alpha for each participant
 subjects = get_participant_list('data', condition)
-corr = np.zeros((len(subjects),))
-corr_p = np.zeros((len(subjects),))
 
 nr_lines = 20
 colors = plt.cm.viridis(np.linspace(0, 1, nr_lines + 1))
 
+band = [BETA_FMIN, BETA_FMAX]
+psd_perc = []
 for i_sub, subject in enumerate(subjects):
     print(subject)
-    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
-
-    raw = mne.io.read_raw_fif(file_name, preload=True)
-    raw.set_eeg_reference('average')
-    raw.pick_channels(['C3'])
-
-    band = [BETA_FMIN, BETA_FMAX]
-    psd_perc, freq = percentile_spectrum(raw, band=band,
-                                         nr_lines=nr_lines,
-                                         nr_seconds=SPEC_NR_SECONDS)
-
-    beta1 = np.mean(psd_perc[:, (freq > band[0]) & (freq < band[1])], axis=1)
+    psd, freq = c3_segment_spectra(subject)
+    psd_perc.append(sort_percentiles(psd, freq, band, nr_lines)[0])
+psd_perc = np.array(psd_perc)
 
-    aband = [ALPHA_FMIN, ALPHA_FMAX]
-    idx_freq = (freq > aband[0]) & (freq < aband[1])
-    alpha1 = np.mean(psd_perc[:, idx_freq], axis=1)
-    
-    # compute 1/f-correction on percentile spectrum
-    psd_corr = np.zeros_like(psd_perc)
-    for i_p in range(psd_perc.shape[0]):
-        fm = fooof.FOOOF(max_n_peaks=SPEC_NR_PEAKS)
-        fm.fit(freqs=freq, power_spectrum=psd_perc[i_p])
-        psd_corr[i_p] = fm.power_spectrum - fm._ap_fit
+# compute 1/f-correction on all percentile spectra of all participants,
+# in one process: worker processes would re-run this unguarded script on
+# platforms that spawn them
+ap_fit, _ = fit_aperiodic(freq, psd_perc.reshape(-1, len(freq)), n_jobs=1)
+psd_corr = np.log10(psd_perc) - ap_fit.reshape(psd_perc.shape)
 
-    beta1 = np.mean(psd_corr[:, (freq > band[0]) & (freq < band[1])], axis=1)
+beta1 = np.mean(psd_corr[:, :, (freq > band[0]) & (freq < band[1])], axis=2)
 
-    aband = [ALPHA_FMIN, ALPHA_FMAX]
-    idx_freq = (freq > aband[0]) & (freq < aband[1])
-    alpha1 = np.mean(psd_corr[:, idx_freq], axis=1)
+aband = [ALPHA_FMIN, ALPHA_FMAX]
+idx_freq = (freq > aband[0]) & (freq < aband[1])
+alpha1 = np.mean(psd_corr[:, :, idx_freq], axis=2)
 
-    corr[i_sub], corr_p[i_sub] = scipy.stats.spearmanr(alpha1, beta1)
+# rank correlation across percentile lines, for all participants at once
+corr, corr_p = stats.spearman(alpha1, beta1)
 
 # %% plot results and selected participants
 subjects_sel = ['sub-032499', 'sub-032517', 'sub-032412', 'sub-032311']
@@ -103,9 +135,8 @@ for i_sub, subject in enumerate(subjects_sel):
 
     ax = plt.subplot(gs2[i_sub])
     file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
-    raw = mne.io.read_raw_fif(file_name, preload=True)
+    raw = mne.io.read_raw_fif(file_name)
     raw.pick_types(eeg=True)
-    raw.set_eeg_reference('average')
 
     band = [BETA_FMIN, BETA_FMAX]
 
@@ -114,12 +145,8 @@ for i_sub, subject in enumerate(subjects_sel):
     colors = plt.cm.viridis(np.linspace(0, 1, nr_lines + 1))
 
     leg = ['top-20%', ' ', ' ', '', 'lowest 20%']
-    idx = mne.pick_channels(raw.ch_names, ['C3'])
-    i_chan = idx[0]
-    psd_perc, freq = percentile_spectrum(raw, band=band,
-                                         nr_seconds=SPEC_NR_SECONDS,
-                                         nr_lines=nr_lines,
-                                         i_chan=i_chan)
+    psd, freq = c3_segment_spectra(subject)
+    psd_perc = sort_percentiles(psd, freq, band, nr_lines)[0]
     for i in range(psd_perc.shape[0]):
         ax.loglog(freq, psd_perc[i], lw=0.85,
                   color=colors[i], zorder=-3 * i, label=leg[i])
@@ -137,11 +164,7 @@ for i_sub, subject in enumerate(subjects_sel):
     ax.spines['left'].set_color(colors2[i_sub])
 
     # plot spatial patterns
-    filter = np.zeros(len(raw.ch_names))
-    filter[idx] = 1
-    raw.filter(BETA_FMIN, BETA_FMAX)
-    cov = np.cov(raw._data)
-    pattern = filter @ cov
+    pattern = beta_pattern(subject)
     ax_ins = inset_axes(ax, width='40%', height='40%', loc='lower left')
     mne.viz.plot_topomap(pattern, raw.info, axes=ax_ins, show=False)
 
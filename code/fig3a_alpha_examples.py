@@ -1,12 +1,13 @@
 # %% FIG 3A
 import matplotlib.pyplot as plt
 import mne
-from params import DATA_DIR, FIG_WIDTH, FIG_DIR, SPEC_NR_SECONDS, \
-    SSD_PARAM_DIR
+from params import DATA_DIR, FIG_WIDTH, FIG_DIR, SPEC_NR_SECONDS
 import numpy as np
 import ssd
-import pandas as pd
-from helper import percentile_spectrum, despine
+import results_store
+from helper import segment_spectra, sort_percentiles
+from plotting import despine
+from spectral_cache import load_or_compute
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 plt.style.use('figures.mplstyle')
@@ -22,21 +23,29 @@ subject_list = [('sub-032362', 'ec'),
 
 for i_sub, (subject, condition) in enumerate(subject_list):
 
-    df = pd.read_csv(f'{SSD_PARAM_DIR}/{subject}_{condition}.csv', index_col=0)
-    # df = df.set_index('subject')
-
-    peak = df.T['alpha_peak'].to_numpy('float')
+    ssd_param = results_store.read_row('ssd_param', subject, condition)
+    peak = np.array([ssd_param['alpha_peak']], dtype='float')
     file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
-    raw = mne.io.read_raw_fif(file_name, preload=True)
+    raw = mne.io.read_raw_fif(file_name)
     raw.pick_types(eeg=True)
 
-    filters, patterns = ssd.run_ssd(raw, peak=peak, band_width=2)
-    raw_ssd = ssd.apply_filters(raw, filters[:, :2])
+    def compute():
+        raw.load_data()
+        filters, patterns = ssd.run_ssd(raw, peak=peak, band_width=2)
+        raw_ssd = ssd.apply_filters(raw, filters[:, :2])
+        psd, freq = segment_spectra(raw_ssd, picks=[0],
+                                    nr_seconds=SPEC_NR_SECONDS)
+        return dict(psd=psd, freq=freq, patterns=patterns)
+
+    key = dict(subject=subject, condition=condition, peak=float(peak[0]),
+               band_width=2, nr_seconds=SPEC_NR_SECONDS)
+    spectra = load_or_compute('ssd_segment_spectra', key, compute,
+                              [file_name])
+    patterns = spectra['patterns']
 
     band = [peak - 2, peak + 2]
-    psd_perc, freq = percentile_spectrum(raw_ssd, band=band,
-                                         nr_seconds=SPEC_NR_SECONDS,
-                                         nr_lines=nr_lines)
+    freq = spectra['freq']
+    psd_perc = sort_percentiles(spectra['psd'], freq, band, nr_lines)[0]
 
     # plot percentile spectrum
     axB = ax.flat[i_sub]
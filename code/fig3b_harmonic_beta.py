@@ -5,7 +5,8 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 import pingouin as pg
-from helper import despine
+from plotting import despine
+from stats import harmonic_fraction_test
 
 plt.style.use('figures.mplstyle')
 
@@ -25,6 +26,12 @@ for i_cond, condition in enumerate(['ec', 'eo']):
 
     df['fraction'] = df['beta_peak'] / df['alpha_peak']
 
+    # permutation test in one process, this script is not guarded for workers
+    fraction, p = harmonic_fraction_test(df.alpha_peak, df.beta_peak,
+                                         n_jobs=1)
+    print(f"{condition}: {100 * fraction:.1f}% harmonic beta peaks, "
+          f"permutation p={p:.4f}")
+
     # jitter just for visualization
     df['alpha_peak'] += 0.05*np.random.randn(len(df))
     df['beta_peak'] += 0.05*np.random.randn(len(df))
@@ -1,11 +1,21 @@
 import os
-import pandas as pd
+import hashlib
 import numpy as np
-import mne
-import matplotlib.pyplot as plt
+import scipy.signal
 
-from params import SSD_DIR, CSV_DIR, SPEC_NR_SECONDS, \
-    DATA_DIR, SPEC_PARAM_DIR, SSD_PARAM_DIR
+from params import CSV_DIR, SPEC_NR_SECONDS, DATA_DIR, SPEC_NR_PEAKS
+import results_store
+from profiling import step
+
+# mne, fooof and pandas are only imported by the functions that need them,
+# so that compute-only worker processes start quickly; the plotting
+# functions are in plotting.py
+
+
+def _has_bad_annotations(raw):
+    """ Check for annotations which mne.Epochs would use to reject data."""
+    return any(desc.lower().startswith('bad')
+               for desc in raw.annotations.description)
 
 
 def percentile_spectrum(raw, band=(8, 12), nr_lines=5, i_chan=0,
@@ -15,6 +25,9 @@ def percentile_spectrum(raw, band=(8, 12), nr_lines=5, i_chan=0,
     segments according to the power in a given frequency band. Divide into
     percentile groups and compute the average PSD for each group.
 
+    Without bad-annotations, the segments are taken as a strided view on the
+    data buffer instead of creating mne.Epochs.
+
     Parameters
     ----------
         band [2 x 1]: frequency band for sorting the PSDs
@@ -29,6 +42,21 @@ def percentile_spectrum(raw, band=(8, 12), nr_lines=5, i_chan=0,
 
     """
 
+    if not _has_bad_annotations(raw):
+        # fast path: segment the data buffer directly, no Epochs copy
+        with step("read"):
+            if raw.preload:
+                data = raw._data[i_chan:i_chan + 1]
+            else:
+                data = raw.get_data(picks=[i_chan])
+        with step("welch"):
+            psd, freq = _segment_spectra(data, raw.info['sfreq'],
+                                         nr_seconds)
+        psd_perc = sort_percentiles(psd, freq, band, nr_lines)[0]
+        return psd_perc, freq
+
+    import mne
+
     events = mne.make_fixed_length_events(raw,
                                           start=0,
                                           stop=raw.times[-1],
@@ -37,11 +65,12 @@ def percentile_spectrum(raw, band=(8, 12), nr_lines=5, i_chan=0,
     epo = mne.Epochs(raw, events, tmin=0, tmax=nr_seconds, baseline=None)
 
     n_fft = nr_seconds * int(raw.info['sfreq'])
-    psd, freq = mne.time_frequency.psd_welch(epo,
-                                             picks=[i_chan],
-                                             fmin=1,
-                                             fmax=45,
-                                             n_fft=n_fft)
+    with step("epochs_welch"):
+        psd, freq = mne.time_frequency.psd_welch(epo,
+                                                 picks=[i_chan],
+                                                 fmin=1,
+                                                 fmax=45,
+                                                 n_fft=n_fft)
 
     idx_start = np.argmin(np.abs(freq - band[0]))
     idx_end = np.argmin(np.abs(freq - band[1]))
@@ -59,84 +88,358 @@ def percentile_spectrum(raw, band=(8, 12), nr_lines=5, i_chan=0,
     return psd_perc, freq
 
 
-def get_participant_list(aspect, condition):
+def _segment_spectra(data, sfreq, nr_seconds=SPEC_NR_SECONDS, fmin=1,
+                     fmax=45, block_size=16):
+    """ Cut continuous signals into consecutive segments of [nr_seconds]
+    length and compute the PSD of each segment. Segments are detrended and
+    Hamming-windowed, as in mne.time_frequency.psd_welch.
 
-    df = pd.read_csv(f'{CSV_DIR}/name_match.csv')
-    subjects = df.INDI_ID
-    subjects_selected = None
-    if aspect == 'data':
-        data_exists = np.zeros((len(subjects),), dtype='bool')
-        for i_sub, subject in enumerate(subjects):
-            fif_fname = f'{DATA_DIR}/{subject}_{condition}-raw.fif'
-            data_exists[i_sub] = os.path.exists(fif_fname)
-        subjects_selected = subjects[np.where(data_exists)[0]].to_list()
-
-    elif aspect == 'ssd':
-        ssd_exists = np.zeros((len(subjects),), dtype='bool')
-        for i_sub, subject in enumerate(subjects):
-            ssd_fname = f"{SSD_DIR}/{subject}_ssd_filters_{condition}.csv"
-            ssd_exists[i_sub] = os.path.exists(ssd_fname)
-        subjects_selected = subjects[np.where(ssd_exists)[0]].to_list()
-
-    elif aspect == 'sensor_param':
-        sparam_exists = np.zeros((len(subjects),), dtype='bool')
-        for i_sub, subject in enumerate(subjects):
-            sparam_fname = f"{SPEC_PARAM_DIR}/{subject}_{condition}.csv"
-            sparam_exists[i_sub] = os.path.exists(sparam_fname)
-        subjects_selected = subjects[np.where(sparam_exists)[0]].to_list()
-
-    elif aspect == 'ssd_param':
-        ssd_param_exists = np.zeros((len(subjects),), dtype='bool')
-        for i_sub, subject in enumerate(subjects):
-            ssd_param_fname = f"{SSD_PARAM_DIR}/{subject}_{condition}.csv"
-            ssd_param_exists[i_sub] = os.path.exists(ssd_param_fname)
-        subjects_selected = subjects[np.where(ssd_param_exists)[0]].to_list()
-
-    subjects = np.sort(subjects_selected)
-
-    return list(subjects)
-
-
-# plot patterns
-def plot_patterns(patterns, raw, nr_components, colors, cmap="RdBu_r"):
-    """Plot a number of spatial patterns as a topography.
+    The segments are a strided view on the data, which is not copied. The
+    FFT is computed for [block_size] segments at a time, so that the working
+    memory is bounded by a few segments instead of the whole recording.
 
     Parameters
     ----------
-        patterns (array): spatial patterns to plot.
-        raw (mne.io.Raw): raw-file for electrode positions.
-        nr_components (int): Number of components that will be plotted.
-        colors (list): List of identifying colors.
-        gs (matplotlib.gridspec.GridSpec): grid for plotting the topographies.
-        cmap (str, optional): Colormap for topographies. Defaults to "RdBu_r".
+        data (array): n_channels x n_times
+        sfreq (float): sampling frequency
+        nr_seconds: segment length
+        fmin, fmax (float): frequency range of the returned PSDs
+        block_size (int): number of segments transformed at once
+
+    Returns
+    -------
+        psd (array): n_channels x n_segments x n_freqs
+        freq (array): frequency axis of computed spectrum
+
     """
 
-    fig, ax = plt.subplots(2, 5)
-    dd = 0
-    cc = 0
-    for i in range(nr_components):
-        ax1 = ax[dd, cc]
+    n_fft = nr_seconds * int(sfreq)
+    n_channels, n_times = data.shape
+    n_segments = (n_times - 1) // n_fft
+
+    segments = np.lib.stride_tricks.sliding_window_view(
+        data[:, :n_segments * n_fft], n_fft, axis=-1)[:, ::n_fft]
+
+    window = scipy.signal.get_window('hamming', n_fft)
+    freq = np.fft.rfftfreq(n_fft, 1 / sfreq)
+    idx_freq = (freq >= fmin) & (freq <= fmax)
+
+    # one-sided power spectral density
+    scale = np.full(len(freq), 2 / (sfreq * np.sum(window ** 2)))
+    scale[0] /= 2
+    if n_fft % 2 == 0:
+        scale[-1] /= 2
+    scale = scale[idx_freq]
+
+    psd = np.zeros((n_channels, n_segments, np.sum(idx_freq)))
+    for i in range(0, n_segments, block_size):
+        block = segments[:, i:i + block_size]
+        block = block - np.mean(block, axis=-1, keepdims=True)
+        spectrum = np.fft.rfft(block * window, axis=-1)[..., idx_freq]
+        psd[:, i:i + block_size] = (spectrum.real ** 2 +
+                                    spectrum.imag ** 2) * scale
+
+    return psd, freq[idx_freq]
+
+
+def sort_percentiles(psd, freq, band, nr_lines):
+    """ Sort segment PSDs by power in a frequency band and average them in
+    [nr_lines] groups, separately for each channel.
+
+    Parameters
+    ----------
+        psd (array): n_channels x n_segments x n_freqs
+        freq (array): frequency axis
+        band [2 x 1]: frequency band for sorting the PSDs
+        nr_lines (int): number of groups
+
+    Returns
+    -------
+        psd_perc (array): n_channels x nr_lines x n_freqs
+
+    """
+
+    n_channels, n_segments, n_freqs = psd.shape
+    idx_start = np.argmin(np.abs(freq - band[0]))
+    idx_end = np.argmin(np.abs(freq - band[1]))
+    mean_power = np.mean(psd[:, :, idx_start:idx_end], axis=-1)
+    idx_segments = np.argsort(mean_power, axis=-1)[:, ::-1]
+
+    spacing = int(np.floor(n_segments/nr_lines))
+    idx_segments = idx_segments[:, :nr_lines * spacing, np.newaxis]
+    psd_sorted = np.take_along_axis(psd, idx_segments, axis=1)
+    psd_sorted = psd_sorted.reshape(n_channels, nr_lines, spacing, n_freqs)
+
+    return np.mean(psd_sorted, axis=2)
+
+
+def segment_spectra(raw, picks=None, nr_seconds=SPEC_NR_SECONDS):
+    """ Compute the PSDs of consecutive segments of [nr_seconds] length for
+    several channels, as used for percentile spectra. Together with
+    sort_percentiles, percentile spectra for different bands and numbers of
+    lines can be computed from one set of segment PSDs.
+
+    Parameters
+    ----------
+        picks (list, optional): channels to use, defaults to all channels
+        nr_seconds: segment length
+
+    Returns
+    -------
+        psd (array): n_channels x n_segments x n_freqs
+        freq (array): frequency axis of computed spectrum
+
+    """
+
+    if raw.preload and picks is None:
+        data = raw._data
+    else:
+        data = raw.get_data(picks=picks)
+
+    return _segment_spectra(data, raw.info['sfreq'], nr_seconds)
+
+
+def percentile_spectra(raw, band=(8, 12), nr_lines=5, picks=None,
+                       nr_seconds=SPEC_NR_SECONDS):
+    """ Compute percentile spectra (see percentile_spectrum) for several
+    channels at once. All channels and segments are transformed in a single
+    batched FFT, the sorting into percentile groups is done per channel.
+    Annotations of the raw-file are not taken into account.
+
+    Parameters
+    ----------
+        band [2 x 1]: frequency band for sorting the PSDs
+        nr_lines (int): number of groups
+        picks (list, optional): channels to use, defaults to all channels
+        nr_seconds: segment length
+
+    Returns
+    -------
+        psd_perc (array): n_channels x nr_lines x n_freqs
+        freq (array): frequency axis of computed spectrum
+
+    """
+
+    psd, freq = segment_spectra(raw, picks, nr_seconds)
+    psd_perc = sort_percentiles(psd, freq, band, nr_lines)
+
+    return psd_perc, freq
+
 
-        idx1 = np.argmax(np.abs(patterns[:, i]))
-        patterns[:, i] = np.sign(patterns[idx1, i]) * patterns[:, i]
-        mne.viz.plot_topomap(patterns[:, i], raw.info, axes=ax1,
-                             cmap=cmap, show=False)
-        ax1.set_title("      ", backgroundcolor=colors[i], fontsize=8)
+def fit_aperiodic(freq, spectra, n_jobs=1, max_n_peaks=SPEC_NR_PEAKS):
+    """ Fit spectral parameterization to a stack of power spectra at once
+    and return the aperiodic fits as one array, so that 1/f-corrected spectra
+    can be computed in one vectorized operation:
+        psd_corr = np.log10(spectra) - ap_fit
 
-        cc += 1
-        if cc == 5:
-            dd += 1
-            cc = 0
-    fig.set_size_inches(8, 3)
+    Parameters
+    ----------
+        freq (array): frequency axis
+        spectra (array): n_spectra x n_freqs, power spectra (linear scale)
+        n_jobs (int): number of parallel jobs for fitting, -1 for all cores
+        max_n_peaks (int): maximal number of peaks to fit
 
-    return fig
+    Returns
+    -------
+        ap_fit (array): n_spectra x n_freqs, aperiodic fits in log10-power,
+            identical to FOOOF._ap_fit of a single fit
+        fg (fooof.FOOOFGroup): fitted group model
 
+    """
 
-def despine(ax):
-    if type(ax) == np.ndarray:
-        for axx in ax.flat:
-            axx.spines['right'].set_visible(False)
-            axx.spines['top'].set_visible(False)
+    import fooof
+
+    fg = fooof.FOOOFGroup(max_n_peaks=max_n_peaks, verbose=False)
+    fg.fit(freq, spectra, n_jobs=n_jobs)
+
+    ap_params = fg.get_params('aperiodic_params')
+    log_freq = np.log10(fg.freqs)[np.newaxis]
+    offset = ap_params[:, [0]]
+    exponent = ap_params[:, [-1]]
+    if fg.aperiodic_mode == 'knee':
+        knee = ap_params[:, [1]]
+        ap_fit = offset - np.log10(knee + 10 ** (exponent * log_freq))
     else:
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
+        ap_fit = offset - exponent * log_freq
+
+    return ap_fit, fg
+
+
+def fit_aperiodic_linear(freq, spectra, percentile_thresh=0.025):
+    """ Fit the aperiodic component of a stack of power spectra without
+    peaks (fixed mode), in one vectorized least-squares pass. As in the
+    robust aperiodic fit of FOOOF, an initial line in log-log space is
+    refitted to the frequencies where the spectrum does not exceed it, which
+    excludes the oscillatory peaks. Much faster than fit_aperiodic for large
+    stacks, at the cost of not modelling the peaks explicitly.
+
+    Parameters
+    ----------
+        freq (array): frequency axis
+        spectra (array): n_spectra x n_freqs, power spectra (linear scale)
+        percentile_thresh (float): percentile of the flattened spectrum
+            below which frequencies are used for the second fit
+
+    Returns
+    -------
+        ap_fit (array): n_spectra x n_freqs, aperiodic fits in log10-power
+        ap_params (array): n_spectra x 2, offset and exponent
+
+    """
+
+    log_freq = np.log10(freq)
+    log_power = np.log10(spectra)
+    design = np.stack((np.ones_like(log_freq), -log_freq), axis=1)
+
+    # initial fit of all spectra at once
+    ap_params = np.linalg.lstsq(design, log_power.T, rcond=None)[0].T
+    flat_spectra = np.maximum(log_power - ap_params @ design.T, 0)
+
+    # refit on the frequencies below the threshold, per spectrum
+    thresh = np.percentile(flat_spectra, percentile_thresh, axis=1,
+                           keepdims=True)
+    weights = (flat_spectra <= thresh).astype(float)
+    sum_w = weights.sum(1)
+    sum_x = weights @ log_freq
+    sum_xx = weights @ log_freq ** 2
+    sum_y = np.sum(weights * log_power, axis=1)
+    sum_xy = np.sum(weights * log_power * log_freq, axis=1)
+    slope = (sum_w * sum_xy - sum_x * sum_y) / (sum_w * sum_xx - sum_x ** 2)
+    offset = (sum_y - slope * sum_x) / sum_w
+
+    ap_params = np.stack((offset, -slope), axis=1)
+    ap_fit = ap_params @ design.T
+
+    return ap_fit, ap_params
+
+
+_participants = dict(subjects=None, data_mtime=None)
+
+
+def _get_subject_ids():
+    if _participants['subjects'] is None:
+        import pandas as pd
+        df = pd.read_csv(f'{CSV_DIR}/name_match.csv')
+        _participants['subjects'] = set(df.INDI_ID)
+    return _participants['subjects']
+
+
+def build_participant_index(conditions=('eo', 'ec')):
+    """ Index the available recordings with one scan of the data folder.
+
+    Recordings are identified by size and modification time, so unchanged
+    files are not read. The content checksum is only computed for indexed
+    recordings whose size or modification time changed, new recordings are
+    indexed without one. Results from the results store missing in the index are
+    added as well. If the data folder does not exist, no recordings are
+    indexed.
+
+    Parameters
+    ----------
+        conditions (tuple): conditions for which recordings are indexed.
+    """
+
+    indexed = results_store.read_index('data')
+    known = {(row.subject, row.condition): row
+             for row in indexed.itertuples()}
+
+    entries = []
+    suffixes = {f"_{condition}-raw.fif": condition for condition in conditions}
+    files = os.scandir(DATA_DIR) if os.path.isdir(DATA_DIR) else []
+    for entry in files:
+        for suffix, condition in suffixes.items():
+            if not entry.name.endswith(suffix):
+                continue
+            subject = entry.name[:-len(suffix)]
+            stat = entry.stat()
+            row = known.get((subject, condition))
+            if row is None:
+                checksum = None
+            elif row.size == stat.st_size and \
+                    row.mtime_ns == stat.st_mtime_ns:
+                checksum = row.checksum
+            else:
+                checksum = file_digest(entry.path)
+            entries.append((subject, condition, checksum, stat.st_size,
+                            stat.st_mtime_ns))
+
+    results_store.update_index(entries, 'data', conditions)
+    results_store.sync_index()
+
+
+def index_recording(subject, condition):
+    """ Add a newly written recording in the data folder to the index,
+    identified by size and modification time."""
+
+    file_name = f'{DATA_DIR}/{subject}_{condition}-raw.fif'
+    if not os.path.exists(file_name):
+        return
+    stat = os.stat(file_name)
+    results_store.update_index([(subject, condition, None, stat.st_size,
+                                 stat.st_mtime_ns)],
+                               'data', conditions=[])
+
+
+def get_participant_list(aspect, condition):
+    """ Return sorted subjects for which an aspect is available.
+
+    Parameters
+    ----------
+        aspect (str): 'data', 'sensor_param', 'ssd', 'ssd_param',
+            'sensor_coupling' or 'phase_coupling'.
+        condition (str): 'eo' or 'ec'.
+
+    Returns
+    -------
+        subjects (list): subject IDs.
+    """
+
+    # the recordings are rescanned once per process and whenever files were
+    # added to or removed from the data folder since
+    if aspect == 'data':
+        mtime = os.stat(DATA_DIR).st_mtime_ns \
+            if os.path.isdir(DATA_DIR) else -1
+        if mtime != _participants['data_mtime']:
+            build_participant_index()
+            _participants['data_mtime'] = mtime
+
+    available = results_store.get_indexed_subjects(aspect, condition)
+    subjects = sorted(_get_subject_ids() & available)
+
+    return subjects
+
+
+def file_digest(file_name, cache=None):
+    """ Compute the SHA-256 content hash of a file.
+
+    Parameters
+    ----------
+        file_name (str): path of the file
+        cache (dict, optional): maps file names to (size, mtime, digest),
+            the file is only re-read if its size or mtime changed
+
+    Returns
+    -------
+        digest (str): hex digest, None if the file does not exist
+
+    """
+
+    if not os.path.exists(file_name):
+        return None
+
+    stat = os.stat(file_name)
+    if cache is not None and file_name in cache:
+        size, mtime, digest = cache[file_name]
+        if size == stat.st_size and mtime == stat.st_mtime_ns:
+            return digest
+
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if cache is not None:
+        cache[file_name] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    return digest
@@ -0,0 +1,196 @@
+""" Online monitoring of alpha and harmonic beta activity with SSD filters.
+
+Blocks of samples from a stream are projected with the precomputed SSD
+filters of a subject (as in ssd.apply_filters), band-pass filtered
+causally around the alpha peak and twice the alpha peak with the filter
+states carried across blocks, and alpha and beta power as well as their
+ratio are updated over a sliding window. A recording replayed block-wise
+stands in for a live stream, e.g. from LSL.
+
+Usage: python online.py subject [condition] [--block-ms B] [--window W]
+                                [--components K] [--realtime]
+"""
+import time
+import argparse
+import collections
+import numpy as np
+import scipy.signal
+
+import ssd
+import results_store
+from raw_mmap import read_raw_mmap
+from params import SSD_WIDTH
+
+
+def load_filters(subject, condition, nr_components=1):
+    """Return SSD filters, channel names and alpha peak of a subject.
+
+    Parameters
+    ----------
+    subject : str
+        Subject ID.
+    condition : str
+        Condition, 'eo' or 'ec'.
+    nr_components : int
+        Number of SSD components to monitor.
+
+    Returns
+    -------
+    filters : array, shape (channels, nr_components)
+        Spatial filters.
+    ch_names : list of str
+        Channel names corresponding to the rows of the filters.
+    peak : float
+        Alpha peak frequency of the SSD components, or of the sensor data
+        if no SSD spectral parameters are available.
+    """
+
+    filters, _, ch_names = results_store.read_ssd(subject, condition)
+
+    ssd_param = results_store.read_row('ssd_param', subject, condition)
+    if ssd_param is not None:
+        peak = ssd_param['alpha_peak']
+    else:
+        sensor_param = results_store.read_row('sensor_param', subject,
+                                              condition)
+        peak = sensor_param['peak_frequency']
+
+    return filters[:, :nr_components], ch_names, float(peak)
+
+
+def replay_blocks(raw, block_size, realtime=False):
+    """Stream a recording block-wise, optionally paced in real time.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Recording to replay, does not need to be preloaded.
+    block_size : int
+        Number of samples per block.
+    realtime : bool
+        If True, wait until each block would have been recorded.
+
+    Yields
+    ------
+    block : array, shape (channels, block_size)
+        Next block of samples.
+    """
+
+    sfreq = raw.info["sfreq"]
+    start_time = time.perf_counter()
+    for start in range(0, raw.n_times - block_size + 1, block_size):
+        if realtime:
+            delay = start_time + (start + block_size) / sfreq - \
+                time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield raw.get_data(start=start, stop=start + block_size)
+
+
+def monitor(blocks, filters, sfreq, peak, band_width=SSD_WIDTH,
+            window=2.0, block_size=None):
+    """Sliding-window alpha and harmonic beta power of SSD components.
+
+    Parameters
+    ----------
+    blocks : iterable of array, shape (channels, n_samples)
+        Incoming blocks of sensor data, all of the same length.
+    filters : array, shape (channels, components)
+        Spatial filters as computed by SSD.
+    sfreq : float
+        Sampling frequency.
+    peak : float
+        Alpha peak frequency, beta is monitored at twice the peak.
+    band_width : float
+        Half width of the alpha and beta frequency bands.
+    window : float
+        Length of the sliding window in seconds.
+    block_size : int | None
+        Number of samples per block, taken from the first block if None.
+
+    Yields
+    ------
+    status : dict
+        Time of the end of the block in seconds, alpha and beta power and
+        their ratio per component over the sliding window, and the
+        processing duration of the block in seconds.
+    """
+
+    nr_components = filters.shape[1]
+    sos_alpha = ssd._iir_sos(sfreq, peak - band_width, peak + band_width)
+    sos_beta = ssd._iir_sos(sfreq, 2 * peak - band_width,
+                            2 * peak + band_width)
+
+    # filter states per component, carried across blocks
+    zi_alpha = np.zeros((sos_alpha.shape[0], nr_components, 2))
+    zi_beta = np.zeros((sos_beta.shape[0], nr_components, 2))
+
+    # power sums per block, summed over the blocks within the window
+    block_sums = collections.deque()
+    window_sum = np.zeros((2, nr_components))
+    nr_samples = 0
+    nr_window = None
+
+    for block in blocks:
+        start = time.perf_counter()
+        if nr_window is None:
+            block_size = block_size or block.shape[1]
+            nr_window = max(int(round(window * sfreq / block_size)), 1)
+
+        components = filters.T @ block
+        alpha, zi_alpha = scipy.signal.sosfilt(sos_alpha, components,
+                                               zi=zi_alpha)
+        beta, zi_beta = scipy.signal.sosfilt(sos_beta, components, zi=zi_beta)
+
+        block_sum = np.array([np.sum(alpha ** 2, axis=1),
+                              np.sum(beta ** 2, axis=1)])
+        block_sums.append(block_sum)
+        window_sum += block_sum
+        if len(block_sums) > nr_window:
+            window_sum -= block_sums.popleft()
+        nr_samples += block.shape[1]
+
+        power = window_sum / (len(block_sums) * block_size)
+        yield dict(time=nr_samples / sfreq, alpha_power=power[0],
+                   beta_power=power[1], ratio=power[1] / power[0],
+                   latency=time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('subject')
+    parser.add_argument('condition', nargs='?', default='eo')
+    parser.add_argument('--block-ms', type=float, default=20,
+                        help="block length in milliseconds")
+    parser.add_argument('--window', type=float, default=2.0,
+                        help="sliding window length in seconds")
+    parser.add_argument('--components', type=int, default=1)
+    parser.add_argument('--realtime', action='store_true',
+                        help="replay the recording at its sampling rate")
+    args = parser.parse_args()
+
+    filters, ch_names, peak = load_filters(args.subject, args.condition,
+                                           args.components)
+    raw = read_raw_mmap(args.subject, args.condition)
+    raw.pick_channels(ch_names, ordered=True)
+    sfreq = raw.info["sfreq"]
+    block_size = int(round(args.block_ms * sfreq / 1000))
+
+    print(f"{args.subject} {args.condition}: alpha peak {peak:.2f} Hz, "
+          f"blocks of {block_size} samples")
+    latencies = []
+    blocks = replay_blocks(raw, block_size, realtime=args.realtime)
+    for status in monitor(blocks, filters, sfreq, peak, window=args.window,
+                          block_size=block_size):
+        latencies.append(status['latency'])
+        if len(latencies) % int(round(1000 / args.block_ms)) == 0:
+            print(f"{status['time']:7.1f} s  alpha "
+                  f"{status['alpha_power'][0]:.3g}  beta "
+                  f"{status['beta_power'][0]:.3g}  beta/alpha "
+                  f"{status['ratio'][0]:.3f}")
+
+    latencies = 1000 * np.array(latencies)
+    print(f"latency per block: median {np.median(latencies):.3f} ms, "
+          f"99th percentile {np.percentile(latencies, 99):.3f} ms, "
+          f"max {latencies.max():.3f} ms")
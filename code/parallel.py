@@ -0,0 +1,131 @@
+""" Process-pool runner for fanning out per-subject processing functions.
+
+Each processing script exposes a `process_1sub(subject, condition)` function.
+`run_parallel` maps such a function over a list of tasks using a pool of
+worker processes, enforces a per-task timeout inside the worker and captures
+failures instead of aborting the whole run.
+"""
+import os
+import signal
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from params import N_JOBS, TASK_TIMEOUT
+
+
+class _TaskTimeout(BaseException):
+    """Raised by the alarm handler. Unlike TimeoutError, it is neither
+    confused with timeouts raised within a task nor caught by the usual
+    `except Exception` of the task."""
+
+
+def _raise_timeout(signum, frame):
+    raise _TaskTimeout()
+
+
+def _run_task(func, args, timeout):
+    """Run a single task and return (result, error-message).
+
+    The timeout is implemented with SIGALRM, so that the worker is freed for
+    the next task. On platforms without SIGALRM no timeout is enforced.
+    """
+
+    use_alarm = timeout is not None and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args), None
+    except _TaskTimeout:
+        return None, f"timeout after {timeout} s"
+    except Exception:
+        return None, traceback.format_exc()
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def get_n_jobs(n_jobs=N_JOBS):
+    """Resolve the number of workers, negative values count from nr cores."""
+
+    nr_cores = os.cpu_count() or 1
+    if n_jobs < 0:
+        n_jobs = nr_cores + 1 + n_jobs
+    return max(1, min(n_jobs, nr_cores))
+
+
+def run_parallel(func, tasks, n_jobs=N_JOBS, timeout=TASK_TIMEOUT,
+                 verbose=True):
+    """Apply a function to a list of argument tuples with a process pool.
+
+    Parameters
+    ----------
+    func : callable
+        Function to apply, e.g. `process_1sub`. Must be importable by the
+        worker processes, i.e. defined at module level.
+    tasks : list of tuple
+        Arguments for each call, e.g. [(subject, condition), ...].
+    n_jobs : int
+        Number of worker processes. -1 uses all cores, 1 runs serially in the
+        current process.
+    timeout : float | None
+        Maximum duration of a single task in seconds.
+    verbose : bool
+        Print progress for each finished task.
+
+    Returns
+    -------
+    results : dict
+        Return values of successful tasks, keyed by the argument tuple.
+    failures : dict
+        Error messages (traceback or timeout) of failed tasks, keyed by the
+        argument tuple.
+    """
+
+    tasks = [tuple(task) for task in tasks]
+    n_jobs = get_n_jobs(n_jobs)
+
+    results = dict()
+    failures = dict()
+
+    def collect(task, result, error):
+        if error is None:
+            results[task] = result
+        else:
+            failures[task] = error
+        if verbose:
+            status = "ok" if error is None else "FAILED"
+            nr_done = len(results) + len(failures)
+            print(f"[{nr_done}/{len(tasks)}] {' '.join(map(str, task))}: "
+                  f"{status}")
+
+    if n_jobs == 1:
+        for task in tasks:
+            collect(task, *_run_task(func, task, timeout))
+        return results, failures
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(_run_task, func, task, timeout): task
+                   for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                result, error = future.result()
+            except Exception:
+                # e.g. a worker got killed by the OS for running out of memory
+                result, error = None, traceback.format_exc()
+            collect(task, result, error)
+
+    return results, failures
+
+
+def report_failures(failures):
+    """Print a short summary of failed tasks."""
+
+    if not failures:
+        return
+    print(f"{len(failures)} task(s) failed:")
+    for task, error in failures.items():
+        print(f"--- {' '.join(map(str, task))}")
+        print(error)
@@ -10,6 +10,15 @@ SPEC_PARAM_DIR = f"{RESULTS_DIR}/sensor_param/"
 SSD_PARAM_DIR = f"{RESULTS_DIR}/ssd_param/"
 SSD_DIR = f'{RESULTS_DIR}/ssd/'
 
+# spectral parameters, SSD filters and patterns of all subjects
+RESULTS_DB = f"{RESULTS_DIR}/results.sqlite"
+
+# recordings converted to memory-mappable float32 arrays
+MMAP_DIR = f"{RESULTS_DIR}/mmap/"
+
+# cross-spectral densities of the recordings, for SSD with method='csd'
+CSD_DIR = f"{RESULTS_DIR}/csd/"
+
 ALPHA_FMIN = 8
 ALPHA_FMAX = 13
 
@@ -27,3 +36,21 @@ SNR_THRESHOLD = 0.5
 
 FIG_DIR = f"{BASE_DIR}/figures/"
 FIG_WIDTH = 8
+
+# parallel processing: number of worker processes (-1: all cores) and
+# maximal duration of processing a single subject in seconds
+N_JOBS = -1
+TASK_TIMEOUT = 3600
+
+# bookkeeping of the incremental pipeline (input hashes per subject)
+PIPELINE_DIR = f"{RESULTS_DIR}/pipeline/"
+
+# timings and peak memory of the benchmarks, per commit
+BENCHMARK_DIR = f"{RESULTS_DIR}/benchmarks/"
+
+# log of durations and memory per processing step, if EEG_PROFILE is set
+PROFILE_DIR = f"{RESULTS_DIR}/profile/"
+
+# cache of spectra shared by processing and figure scripts
+CACHE_DIR = f"{RESULTS_DIR}/cache/"
+CACHE_MAX_GB = 20
@@ -0,0 +1,224 @@
+""" Percentile spectrum of a stream, updated one segment at a time.
+
+helper.percentile_spectrum sorts all segments of a recording by their power
+in a frequency band before averaging them in groups. Here, the rank of each
+new segment is estimated from a streaming histogram sketch of the band
+power seen so far, and its PSD is added to the running mean of the
+corresponding group, so memory does not grow with the recording length.
+Optionally, segment PSDs are spilled to disk, from which the exact
+percentile spectrum (identical to helper.percentile_spectrum) is computed
+when the stream ends.
+"""
+import os
+import numpy as np
+
+from helper import _segment_spectra
+from params import SPEC_NR_SECONDS
+
+
+def segment_stream(blocks, sfreq, nr_seconds=SPEC_NR_SECONDS, fmin=1,
+                   fmax=45):
+    """Compute segment PSDs of a stream of sample blocks.
+
+    Segments are consecutive and [nr_seconds] long, as in
+    helper.percentile_spectrum. A segment is complete once the first sample
+    after it arrived, which gives the same segments as for the recording.
+
+    Parameters
+    ----------
+    blocks : iterable of array, shape (channels, n_samples)
+        Incoming blocks of samples, of any length.
+    sfreq : float
+        Sampling frequency.
+    nr_seconds : int
+        Segment length in seconds.
+    fmin, fmax : float
+        Frequency range of the PSDs.
+
+    Yields
+    ------
+    psd : array, shape (channels, n_segments, n_freqs)
+        PSDs of the segments completed by a block.
+    freq : array
+        Frequency axis of the PSDs.
+    """
+
+    n_fft = nr_seconds * int(sfreq)
+    buffer = None
+    for block in blocks:
+        buffer = block if buffer is None else np.hstack((buffer, block))
+        n_segments = (buffer.shape[1] - 1) // n_fft
+        if n_segments == 0:
+            continue
+        psd, freq = _segment_spectra(buffer[:, :n_segments * n_fft + 1],
+                                     sfreq, nr_seconds, fmin, fmax)
+        buffer = buffer[:, n_segments * n_fft:]
+        yield psd, freq
+
+
+class PercentileSpectrum:
+    """Running percentile spectrum of one channel.
+
+    Segments are assigned to a group by their rank among the segments seen
+    so far, so early segments may end up in a neighbouring group and the
+    estimate approaches the exact result as the stream grows. Used as a
+    context manager, the spill file is closed and removed on exit.
+
+    Parameters
+    ----------
+    freq : array
+        Frequency axis of the segment PSDs.
+    band : tuple
+        Frequency band for sorting the segments.
+    nr_lines : int
+        Number of groups.
+    spill_file : str | None
+        File to which segment PSDs are appended, needed for the exact
+        result. If None, only the estimate is available.
+    resolution : float
+        Width of the histogram bins of the band power in decades.
+    """
+
+    def __init__(self, freq, band=(8, 12), nr_lines=5, spill_file=None,
+                 resolution=0.01):
+        self.freq = freq
+        self.nr_lines = nr_lines
+        self.idx_start = np.argmin(np.abs(freq - band[0]))
+        self.idx_end = np.argmin(np.abs(freq - band[1]))
+
+        # histogram of log10 band power, from 1e-40 to 1e10
+        self.resolution = resolution
+        self.histogram = np.zeros(int(50 / resolution) + 1, dtype='int64')
+
+        self.group_sums = np.zeros((nr_lines, len(freq)))
+        self.group_counts = np.zeros(nr_lines, dtype='int64')
+        self.nr_segments = 0
+
+        # band power per segment is only kept for the exact result
+        self.band_power = []
+
+        self.spill_file = spill_file
+        self._spill = None
+        if spill_file is not None:
+            self._spill = open(spill_file, 'wb')
+
+    def _bin(self, power):
+        log_power = np.log10(max(power, 1e-40))
+        return min(int((log_power + 40) / self.resolution),
+                   len(self.histogram) - 1)
+
+    def add(self, psd):
+        """Add segment PSDs, shape (n_freqs,) or (n_segments, n_freqs)."""
+
+        psd = np.atleast_2d(psd)
+        mean_power = np.mean(psd[:, self.idx_start:self.idx_end], axis=-1)
+
+        for segment, power in zip(psd, mean_power):
+            i_bin = self._bin(power)
+            self.histogram[i_bin] += 1
+            self.nr_segments += 1
+
+            # fraction of segments seen so far with higher band power
+            nr_higher = self.histogram[i_bin + 1:].sum() + \
+                0.5 * (self.histogram[i_bin] - 1)
+            fraction = nr_higher / self.nr_segments
+            i_group = min(int(fraction * self.nr_lines), self.nr_lines - 1)
+            self.group_sums[i_group] += segment
+            self.group_counts[i_group] += 1
+
+        if self._spill is not None:
+            self.band_power.extend(mean_power)
+            self._spill.write(np.ascontiguousarray(psd, 'float64').tobytes())
+
+    def estimate(self):
+        """Running group means, shape (nr_lines, n_freqs)."""
+
+        return self.group_sums / np.maximum(self.group_counts, 1)[:, None]
+
+    def exact(self, chunk_size=256):
+        """Percentile spectrum from the spilled PSDs, shape (nr_lines,
+        n_freqs), identical to sorting all segments at once."""
+
+        if self._spill is None:
+            raise ValueError("the exact result needs a spill_file")
+        self._spill.flush()
+
+        psd = np.memmap(self.spill_file, dtype='float64', mode='r',
+                        shape=(self.nr_segments, len(self.freq)))
+        idx_segments = np.argsort(np.array(self.band_power))[::-1]
+        spacing = int(np.floor(self.nr_segments / self.nr_lines))
+
+        psd_perc = np.zeros((self.nr_lines, len(self.freq)))
+        for i in range(self.nr_lines):
+            idx_group = np.sort(idx_segments[i * spacing:(i + 1) * spacing])
+            for start in range(0, spacing, chunk_size):
+                psd_perc[i] += psd[idx_group[start:start + chunk_size]].sum(0)
+            psd_perc[i] /= spacing
+
+        return psd_perc
+
+    def close(self, remove=True):
+        """Close and optionally remove the spill file."""
+
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+            if remove:
+                os.remove(self.spill_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def percentile_spectrum_stream(blocks, sfreq, band=(8, 12), nr_lines=5,
+                               i_chan=0, nr_seconds=SPEC_NR_SECONDS,
+                               spill_file=None):
+    """Percentile spectrum of one channel of a stream of sample blocks.
+
+    Parameters
+    ----------
+    blocks : iterable of array, shape (channels, n_samples)
+        Incoming blocks of samples.
+    sfreq : float
+        Sampling frequency.
+    band : tuple
+        Frequency band for sorting the segments.
+    nr_lines : int
+        Number of groups.
+    i_chan : int
+        Channel index.
+    nr_seconds : int
+        Segment length in seconds.
+    spill_file : str | None
+        If given, segment PSDs are spilled to this file and the exact
+        percentile spectrum is returned, otherwise the streaming estimate.
+
+    Returns
+    -------
+    psd_perc : array, shape (nr_lines, n_freqs)
+        Percentile spectrum.
+    freq : array
+        Frequency axis of the spectrum.
+    """
+
+    percentiles = None
+    try:
+        for psd, freq in segment_stream(blocks, sfreq, nr_seconds):
+            if percentiles is None:
+                percentiles = PercentileSpectrum(freq, band, nr_lines,
+                                                 spill_file)
+            percentiles.add(psd[i_chan])
+
+        if percentiles is None:
+            raise ValueError(f"the stream contains no complete segment of "
+                             f"{nr_seconds} s")
+        if spill_file is None:
+            return percentiles.estimate(), percentiles.freq
+        return percentiles.exact(), percentiles.freq
+    finally:
+        # the spill file is removed also if the stream or a step fails
+        if percentiles is not None:
+            percentiles.close()
@@ -0,0 +1,474 @@
+""" Incremental pipeline: proc0 -> mmap -> proc1 -> proc2 -> proc3 -> figures.
+
+The whole-head alpha-beta coupling (proc4) runs alongside on the data, the
+phase coupling (proc5) on the SSD components after proc3.
+
+Each stage is run per task (usually subject and condition). A task is only
+recomputed if the content hash of its input files or the value of one of
+the parameters from params.py it depends on changed since the last run, or
+if one of its recorded outputs was modified or deleted. Outputs of tasks
+that are recomputed are set aside and only discarded once the task
+succeeded, outputs of tasks that disappeared upstream are removed, so stale
+results cannot survive a parameter change. Outputs that exist before the
+first run of a stage are taken over instead of rebuilt. Tasks with missing
+inputs are reported as failed and keep their outputs. Rows of the results
+store are tracked like files, by a hash over their content.
+
+Usage: python pipeline.py [stage ...] [--n-jobs N] [--dry-run] [--force]
+"""
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import subprocess
+
+import params
+from params import DATA_DIR, SSD_DIR, CSV_DIR, FIG_DIR, PIPELINE_DIR, \
+    N_JOBS
+from helper import file_digest, get_participant_list, \
+    build_participant_index
+import results_store
+from parallel import run_parallel, report_failures
+import proc0_convert_data_to_mne as proc0
+import raw_mmap
+import proc1_sensor_alpha_frequency as proc1
+import proc2_compute_ssd as proc2
+import proc3_spec_param_on_ssd as proc3
+import proc4_sensor_coupling as proc4
+import proc5_phase_coupling as proc5
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONDITIONS = ('eo', 'ec')
+
+
+def run_figure(script):
+    subprocess.run([sys.executable, script], cwd=CODE_DIR, check=True)
+
+
+def _data_files():
+    return sorted(glob.glob(f"{DATA_DIR}/*-raw.fif"))
+
+
+def _compiled_files():
+    return [f"{CSV_DIR}/ssd_param_{condition}.csv" for condition in CONDITIONS]
+
+
+def _subject_tasks(aspect):
+    return [(subject, condition) for condition in CONDITIONS
+            for subject in get_participant_list(aspect, condition)]
+
+
+# figure scripts with their output files, input files and parameters
+FIGURES = {
+    'fig1a_rhythms_simulated.py': dict(
+        outputs=['fig1a_rhythms_simulated.pdf'],
+        inputs=lambda: [],
+        params=('SPEC_NR_SECONDS',)),
+    'fig1b_rhythms_empirical.py': dict(
+        outputs=['fig1b_rhythms_empirical.pdf'],
+        inputs=_data_files,
+        params=('SPEC_NR_SECONDS',)),
+    'fig2a_percentile_spectrum_simulation.py': dict(
+        outputs=['fig2a_percentile_spec_simulation.pdf'],
+        inputs=lambda: [],
+        params=('BETA_FMIN', 'BETA_FMAX', 'FIG_WIDTH')),
+    'fig2b_sensor_space.py': dict(
+        outputs=['fig2b_C3_sensor_space.pdf'],
+        inputs=_data_files,
+        params=('BETA_FMIN', 'BETA_FMAX', 'ALPHA_FMIN', 'ALPHA_FMAX',
+                'FIG_WIDTH', 'SPEC_NR_SECONDS', 'SPEC_NR_PEAKS')),
+    'fig3a_alpha_examples.py': dict(
+        outputs=['fig3a_alpha_examples.pdf'],
+        inputs=lambda: _data_files() + _compiled_files(),
+        params=('FIG_WIDTH', 'SPEC_NR_SECONDS')),
+    'fig3b_harmonic_beta.py': dict(
+        outputs=['fig3b_alpha_frequencies.pdf'],
+        inputs=_compiled_files,
+        params=('FIG_WIDTH', 'FRAC_DEVIATION')),
+}
+
+
+# stages in topological order, each defines its tasks, input and output
+# files and rows of the results store per task, the parameters it depends on
+# and the processing function
+STAGES = {
+    'proc0': dict(
+        depends=(),
+        tasks=proc0.get_subject_list,
+        inputs=lambda subject, initial_name: [
+            proc0.get_source_file(initial_name)[:-len('vhdr')] + ext
+            for ext in ('vhdr', 'vmrk', 'eeg')],
+        outputs=lambda subject, initial_name: [
+            f"{DATA_DIR}/{subject}_{condition}-raw.fif"
+            for condition in proc0.cond_list.values()],
+        params=(),
+        func=proc0.process_1sub),
+    'mmap': dict(
+        depends=('proc0',),
+        tasks=lambda: _subject_tasks('data'),
+        inputs=lambda subject, condition: [
+            f"{DATA_DIR}/{subject}_{condition}-raw.fif"],
+        outputs=lambda subject, condition: list(
+            raw_mmap.get_mmap_files(subject, condition)),
+        params=(),
+        func=raw_mmap.convert_to_mmap),
+    'proc1': dict(
+        depends=('mmap',),
+        tasks=lambda: _subject_tasks('data'),
+        inputs=lambda subject, condition: [
+            f"{DATA_DIR}/{subject}_{condition}-raw.fif"],
+        outputs=lambda subject, condition: [],
+        output_records=lambda subject, condition: [
+            ('sensor_param', subject, condition)],
+        params=('SPEC_FMIN', 'SPEC_FMAX', 'SPEC_NR_SECONDS', 'SPEC_NR_PEAKS',
+                'ALPHA_FMIN', 'ALPHA_FMAX'),
+        func=proc1.process_1sub),
+    'proc2': dict(
+        depends=('mmap', 'proc1'),
+        tasks=lambda: _subject_tasks('sensor_param'),
+        inputs=lambda subject, condition: [
+            f"{DATA_DIR}/{subject}_{condition}-raw.fif"],
+        input_records=lambda subject, condition: [
+            ('sensor_param', subject, condition)],
+        outputs=lambda subject, condition: [
+            f"{SSD_DIR}/{subject}_{condition}_raw.fif"],
+        output_records=lambda subject, condition: [
+            ('ssd_filters', subject, condition)],
+        params=('SSD_WIDTH', 'SNR_THRESHOLD'),
+        func=proc2.process_1sub),
+    'proc3': dict(
+        depends=('proc2',),
+        tasks=lambda: _subject_tasks('ssd'),
+        inputs=lambda subject, condition: [
+            f"{SSD_DIR}/{subject}_{condition}_raw.fif"],
+        outputs=lambda subject, condition: [],
+        output_records=lambda subject, condition: [
+            ('ssd_param', subject, condition)],
+        params=('ALPHA_FMIN', 'ALPHA_FMAX', 'SPEC_NR_SECONDS',
+                'SPEC_NR_PEAKS', 'SNR_THRESHOLD'),
+        func=proc3.process_1sub),
+    'compile': dict(
+        depends=('proc3',),
+        tasks=lambda: [(condition,) for condition in CONDITIONS],
+        inputs=lambda condition: [],
+        input_records=lambda condition: [
+            ('ssd_param', subject, condition)
+            for subject in results_store.get_subjects('ssd_param', condition)],
+        outputs=lambda condition: [f"{CSV_DIR}/ssd_param_{condition}.csv"],
+        params=(),
+        func=proc3.compile_results),
+    'coupling': dict(
+        depends=('mmap',),
+        tasks=lambda: _subject_tasks('data'),
+        inputs=lambda subject, condition: [
+            f"{DATA_DIR}/{subject}_{condition}-raw.fif"],
+        outputs=lambda subject, condition: [],
+        output_records=lambda subject, condition: [
+            ('sensor_coupling', subject, condition)],
+        params=('ALPHA_FMIN', 'ALPHA_FMAX', 'BETA_FMIN', 'BETA_FMAX',
+                'SPEC_NR_SECONDS', 'SPEC_NR_PEAKS'),
+        func=proc4.process_1sub),
+    'compile_coupling': dict(
+        depends=('coupling',),
+        tasks=lambda: [(condition,) for condition in CONDITIONS],
+        inputs=lambda condition: [],
+        input_records=lambda condition: [
+            ('sensor_coupling', subject, condition)
+            for subject in results_store.get_subjects('sensor_coupling',
+                                                      condition)],
+        outputs=lambda condition: [
+            f"{CSV_DIR}/sensor_coupling_{condition}.csv"],
+        params=(),
+        func=proc4.compile_results),
+    'phase': dict(
+        depends=('proc3',),
+        tasks=lambda: _subject_tasks('ssd_param'),
+        inputs=lambda subject, condition: [
+            f"{SSD_DIR}/{subject}_{condition}_raw.fif"],
+        input_records=lambda subject, condition: [
+            ('ssd_param', subject, condition)],
+        outputs=lambda subject, condition: [],
+        output_records=lambda subject, condition: [
+            ('phase_coupling', subject, condition)],
+        params=('SSD_WIDTH', 'SPEC_NR_SECONDS'),
+        func=proc5.process_1sub),
+    'compile_phase': dict(
+        depends=('phase',),
+        tasks=lambda: [(condition,) for condition in CONDITIONS],
+        inputs=lambda condition: [],
+        input_records=lambda condition: [
+            ('phase_coupling', subject, condition)
+            for subject in results_store.get_subjects('phase_coupling',
+                                                      condition)],
+        outputs=lambda condition: [
+            f"{CSV_DIR}/phase_coupling_{condition}.csv"],
+        params=(),
+        func=proc5.compile_results),
+    'figures': dict(
+        depends=('proc0', 'compile'),
+        tasks=lambda: [(script,) for script in FIGURES],
+        inputs=lambda script: FIGURES[script]['inputs'](),
+        outputs=lambda script: [f"{FIG_DIR}/{fig_name}"
+                                for fig_name in FIGURES[script]['outputs']],
+        params=lambda script: FIGURES[script]['params'],
+        func=run_figure),
+}
+
+
+def _load_json(file_name):
+    if not os.path.exists(file_name):
+        return dict()
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def _save_json(data, file_name):
+    os.makedirs(PIPELINE_DIR, exist_ok=True)
+    tmp_name = f"{file_name}.tmp"
+    with open(tmp_name, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_name, file_name)
+
+
+def _task_id(task):
+    return '|'.join(map(str, task))
+
+
+def _record_id(record):
+    return '|'.join(record)
+
+
+def _records(stage, kind, task):
+    return stage.get(kind, lambda *task: [])(*task)
+
+
+def _remove(files, records=()):
+    for file_name in files:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    for record_id in records:
+        results_store.delete_row(*record_id.split('|'))
+
+
+def _set_aside(files, records):
+    """Move the outputs of a task out of the way before it is recomputed.
+
+    Returns a backup from which _restore puts them back if the task fails.
+    """
+
+    backup = dict(files=dict(), records=dict())
+    for file_name in files:
+        if os.path.exists(file_name):
+            backup_name = f"{file_name}.{os.getpid()}.bak"
+            os.replace(file_name, backup_name)
+            backup['files'][file_name] = backup_name
+    for record_id in records:
+        row = results_store.read_row(*record_id.split('|'))
+        if row is not None:
+            backup['records'][record_id] = row
+            results_store.delete_row(*record_id.split('|'))
+    return backup
+
+
+def _restore(backup):
+    for file_name, backup_name in backup['files'].items():
+        os.replace(backup_name, file_name)
+    for record_id, row in backup['records'].items():
+        table, subject, condition = record_id.split('|')
+        values = {name: row[name] for name in results_store.TABLES[table]}
+        results_store.write_row(table, subject, condition, **values)
+
+
+def _discard(backup):
+    for backup_name in backup['files'].values():
+        os.remove(backup_name)
+
+
+def missing_inputs(stage, task):
+    """Input files and rows of a task that do not exist."""
+
+    missing = [file_name for file_name in stage['inputs'](*task)
+               if not os.path.exists(file_name)]
+    missing += [_record_id(record)
+                for record in _records(stage, 'input_records', task)
+                if results_store.row_digest(*record) is None]
+    return missing
+
+
+def manifest_entry(stage, task, key, digests):
+    """Manifest entry of a task from its existing outputs, None if some of
+    its outputs do not exist or it has none."""
+
+    output_files = stage['outputs'](*task)
+    output_records = [_record_id(record)
+                      for record in _records(stage, 'output_records', task)]
+
+    outputs = {file_name: file_digest(file_name, digests)
+               for file_name in output_files}
+    records = {record_id: results_store.row_digest(*record_id.split('|'))
+               for record_id in output_records}
+    if len(outputs) + len(records) == 0 or \
+            None in outputs.values() or None in records.values():
+        return None
+    return dict(key=key, outputs=outputs, records=records)
+
+
+def task_key(stage, task, digests):
+    """Hash over the parameter values and input file contents of a task."""
+
+    param_names = stage['params']
+    if callable(param_names):
+        param_names = param_names(*task)
+
+    sha = hashlib.sha256()
+    for name in param_names:
+        sha.update(f"{name}={getattr(params, name)!r};".encode())
+    for file_name in stage['inputs'](*task):
+        digest = file_digest(file_name, digests)
+        sha.update(f"{os.path.basename(file_name)}={digest};".encode())
+    for record in _records(stage, 'input_records', task):
+        digest = results_store.row_digest(*record)
+        sha.update(f"{_record_id(record)}={digest};".encode())
+
+    return sha.hexdigest()
+
+
+def is_current(entry, key, digests):
+    """Check whether a manifest entry matches the key and its outputs."""
+
+    if entry is None or entry['key'] != key:
+        return False
+    for file_name, digest in entry['outputs'].items():
+        if file_digest(file_name, digests) != digest:
+            return False
+    for record_id, digest in entry.get('records', dict()).items():
+        if results_store.row_digest(*record_id.split('|')) != digest:
+            return False
+    return True
+
+
+def run_stage(name, n_jobs=N_JOBS, dry_run=False, force=False):
+    """Recompute all out-of-date tasks of one pipeline stage."""
+
+    stage = STAGES[name]
+    manifest_file = f"{PIPELINE_DIR}/{name}.json"
+    digests_file = f"{PIPELINE_DIR}/file_digests.json"
+    manifest = _load_json(manifest_file)
+    digests = _load_json(digests_file)
+
+    # upstream stages may have added or removed recordings
+    build_participant_index(CONDITIONS)
+    tasks = [tuple(task) for task in stage['tasks']()]
+    if len(tasks) == 0 and len(manifest) > 0:
+        raise RuntimeError(f"no tasks found for stage {name}, refusing to "
+                           "remove its results. Are the data available?")
+
+    # results of tasks that disappeared upstream are stale
+    vanished = set(manifest) - {_task_id(task) for task in tasks}
+
+    keys = dict()
+    adopted = dict()
+    failures = dict()
+    for task in tasks:
+        entry = manifest.get(_task_id(task))
+        key = task_key(stage, task, digests)
+        if not force and is_current(entry, key, digests):
+            continue
+
+        # outputs from before the first run are taken over, not rebuilt
+        if entry is None and not force:
+            entry = manifest_entry(stage, task, key, digests)
+            if entry is not None:
+                adopted[_task_id(task)] = entry
+                continue
+
+        # without its inputs a task cannot be recomputed, its outputs are
+        # kept until the inputs are available again
+        missing = missing_inputs(stage, task)
+        if missing:
+            failures[task] = f"missing inputs: {', '.join(missing)}"
+            continue
+
+        keys[task] = key
+
+    print(f"{name}: {len(keys)} of {len(tasks)} tasks out of date, "
+          f"{len(adopted)} existing taken over, {len(failures)} with missing "
+          f"inputs, {len(vanished)} removed")
+    if dry_run:
+        return
+
+    manifest.update(adopted)
+    for task_id in vanished:
+        entry = manifest.pop(task_id)
+        _remove(entry['outputs'], entry.get('records', dict()))
+
+    # outputs are set aside and only discarded once the task succeeded
+    backups = {task: _set_aside(stage['outputs'](*task),
+                                [_record_id(record) for record in
+                                 _records(stage, 'output_records', task)])
+               for task in keys}
+
+    results, task_failures = run_parallel(stage['func'], list(keys),
+                                          n_jobs=n_jobs)
+    failures.update(task_failures)
+
+    for task in keys:
+        if task not in results:
+            _restore(backups[task])
+            continue
+        _discard(backups[task])
+        outputs = {file_name: file_digest(file_name, digests)
+                   for file_name in stage['outputs'](*task)
+                   if os.path.exists(file_name)}
+        records = {_record_id(record): results_store.row_digest(*record)
+                   for record in _records(stage, 'output_records', task)}
+        records = {record_id: digest for record_id, digest in records.items()
+                   if digest is not None}
+        manifest[_task_id(task)] = dict(key=keys[task], outputs=outputs,
+                                        records=records)
+
+    _save_json(manifest, manifest_file)
+    _save_json(digests, digests_file)
+    report_failures(failures)
+
+
+def resolve_stages(targets):
+    """Return the targets and all their upstream stages in pipeline order."""
+
+    required = set()
+
+    def add(name):
+        if name not in required:
+            required.add(name)
+            for dependency in STAGES[name]['depends']:
+                add(dependency)
+
+    for target in targets:
+        add(target)
+
+    return [name for name in STAGES if name in required]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('stages', nargs='*',
+                        help="stages to bring up to date, default: all")
+    parser.add_argument('--n-jobs', type=int, default=N_JOBS)
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only report out-of-date tasks, stages "
+                             "downstream are evaluated on current results")
+    parser.add_argument('--force', action='store_true',
+                        help="recompute all tasks of the given stages")
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages {sorted(unknown)}, "
+                     f"choose from {list(STAGES)}")
+
+    targets = args.stages or list(STAGES)
+    for name in resolve_stages(targets):
+        force = args.force and name in targets
+        run_stage(name, args.n_jobs, dry_run=args.dry_run, force=force)
@@ -0,0 +1,74 @@
+""" Plotting functions for the figures, kept apart from the computations so
+that processing workers do not need to import matplotlib.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+import mne
+
+
+def plot_patterns(patterns, raw, nr_components, colors, cmap="RdBu_r"):
+    """Plot a number of spatial patterns as a topography.
+
+    Parameters
+    ----------
+        patterns (array): spatial patterns to plot.
+        raw (mne.io.Raw): raw-file for electrode positions.
+        nr_components (int): Number of components that will be plotted.
+        colors (list): List of identifying colors.
+        gs (matplotlib.gridspec.GridSpec): grid for plotting the topographies.
+        cmap (str, optional): Colormap for topographies. Defaults to "RdBu_r".
+    """
+
+    fig, ax = plt.subplots(2, 5)
+    dd = 0
+    cc = 0
+    for i in range(nr_components):
+        ax1 = ax[dd, cc]
+
+        idx1 = np.argmax(np.abs(patterns[:, i]))
+        patterns[:, i] = np.sign(patterns[idx1, i]) * patterns[:, i]
+        mne.viz.plot_topomap(patterns[:, i], raw.info, axes=ax1,
+                             cmap=cmap, show=False)
+        ax1.set_title("      ", backgroundcolor=colors[i], fontsize=8)
+
+        cc += 1
+        if cc == 5:
+            dd += 1
+            cc = 0
+    fig.set_size_inches(8, 3)
+
+    return fig
+
+
+def despine(ax):
+    if type(ax) == np.ndarray:
+        for axx in ax.flat:
+            axx.spines['right'].set_visible(False)
+            axx.spines['top'].set_visible(False)
+    else:
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+
+
+def plot_ssd_patterns(patterns, raw, nr_patterns=10):
+    """Convenience plotting function for checking spatial patterns.
+
+    Args:
+        patterns : array, 2-D
+            Spatial patterns.
+        raw : instance of Raw
+            Raw instance containing electrode positions.
+        nr_patterns :  int (optional)
+            Number of patterns to be plotted. Defaults to 10.
+    """
+
+    nr_cols = 4
+    nr_rows = int(np.ceil(nr_patterns/4))
+
+    fig, ax = plt.subplots(nr_rows, nr_cols)
+
+    for i in range(nr_patterns):
+        ax1 = ax.flatten()[i]
+        mne.viz.plot_topomap(patterns[:, i], raw.info, axes=ax1)
+
+    fig.show()
@@ -5,57 +5,124 @@ import pandas as pd
 import numpy as np
 
 from params import DATA_DIR, CSV_DIR
+from helper import index_recording
+from parallel import run_parallel, report_failures
+from profiling import profile_task, step
 
 data_DIR = DATA_DIR
 new_data_DIR = '/cs/department2/data/eeg_lemon/raw_renamed/'
-os.makedirs(new_data_DIR, exist_ok=True)
 
+# S200 eyes open, S10 eyes closed
+cond_list = {210: 'ec', 200: 'eo'}
 
-df = pd.read_csv(f'{CSV_DIR}/name_match2.csv')
-subjects = df.INDI_ID
 
-folder = '/cs/department2/data/eeg_lemon/epo_from_raw/'
-os.makedirs(folder, exist_ok=True)
-
-for i_sub, subject in enumerate(subjects):
-    print(i_sub, subject)
+def get_source_file(initial_name):
+    file_type = 'vhdr'
+    return f"{new_data_DIR}/{initial_name}/RSEEG/{initial_name}.{file_type}"
 
-    initial_name, bids_name = df.iloc[i_sub]
 
-    os.makedirs(f"{data_DIR}/{subject}/RSEEG", exist_ok=True) 
-    file_type = 'vhdr'
-    new_file = f"{new_data_DIR}/{initial_name}/RSEEG/{initial_name}.{file_type}"
+def get_subject_list():
+    df = pd.read_csv(f'{CSV_DIR}/name_match2.csv')
+    return list(zip(df.INDI_ID, df.Initial_ID))
 
-    # S200 eyes open, S10 eyes closed
-    cond_list = {210: 'ec', 200: 'eo'}
-    trigger = 210
 
-    # load raw
-    raw_file_name = f'{folder}/{subject}_{cond_list[trigger]}-raw.fif'
-    if os.path.exists(raw_file_name):
-        continue
+def _overlaps_bad_segment(raw, start, stop):
+    """ Check whether samples overlap with a segment annotated as bad."""
+    for annot in raw.annotations:
+        if not annot['description'].lower().startswith('bad'):
+            continue
+        onset = raw.time_as_index(annot['onset'], use_rounding=True)[0]
+        offset = onset + int(round(annot['duration'] * raw.info['sfreq']))
+        if onset < stop and offset > start:
+            return True
+    return False
+
+
+def extract_blocks(raw, events, trigger, l_freq=0.5, duration=60):
+    """ Cut the recording blocks of one condition and high-pass filter them.
+
+    Only the samples of each block plus a margin of one filter length are
+    read and filtered, which gives the same result as filtering the whole
+    recording before cutting.
+
+    Parameters
+    ----------
+        raw (mne.io.Raw): continuous recording, does not need to be loaded.
+        events (np.ndarray): events of the recording.
+        trigger (int): trigger code marking the start of the condition.
+        l_freq (float): high-pass cutoff frequency in Hz.
+        duration (float): duration of one block in seconds.
+
+    Returns
+    -------
+        raw_blocks (mne.io.RawArray): concatenated blocks.
+    """
+
+    sfreq = raw.info['sfreq']
+    n_block = int(round(duration * sfreq)) + 1
+    margin = len(mne.filter.create_filter(None, sfreq, l_freq, None))
+
+    # the first trigger of each block, triggers repeat within a block
+    condA = mne.pick_events(events, trigger)
+    idx, = np.where(np.diff(condA[:, 0]) > 15000)
+    condB = np.vstack((condA[0], condA[idx + 1]))
+    starts = [start for start in condB[:, 0] - raw.first_samp
+              if start >= 0 and start + n_block <= raw.n_times and not
+              _overlaps_bad_segment(raw, start, start + n_block)]
+
+    data = np.empty((len(raw.ch_names), len(starts) * n_block))
+    for i_block, start in enumerate(starts):
+        read_start = max(start - margin, 0)
+        read_stop = min(start + n_block + margin, raw.n_times)
+        raw_block = mne.io.RawArray(
+            raw.get_data(start=read_start, stop=read_stop), raw.info)
+        raw_block.filter(l_freq, None, verbose=False)
+        offset = start - read_start
+        data[:, i_block * n_block:(i_block + 1) * n_block] = \
+            raw_block._data[:, offset:offset + n_block]
+
+    info = raw_block.info if len(starts) else raw.info
+    return mne.io.RawArray(data, info)
+
+
+@profile_task
+def process_1sub(subject, initial_name):
+
+    os.makedirs(f"{data_DIR}/{subject}/RSEEG", exist_ok=True)
+    new_file = get_source_file(initial_name)
+
+    raw_file_names = {trigger: f'{data_DIR}/{subject}_{condition}-raw.fif'
+                      for trigger, condition in cond_list.items()}
+    triggers = [trigger for trigger, raw_file_name in raw_file_names.items()
+                if not os.path.exists(raw_file_name)]
+    if len(triggers) == 0:
+        return
 
     if not(os.path.exists(new_file)):
-        continue
+        raise FileNotFoundError(f"no source recording {new_file}")
 
+    # both conditions are cut from one recording, which is read block-wise
     raw = mne.io.read_raw_brainvision(new_file, eog=['VEOG'])
-    raw.load_data()
-    raw.filter(0.5, None)
     events, event_id = mne.events_from_annotations(raw)
 
-    for trigger in cond_list.keys():
+    for trigger in triggers:
+        with step("extract_blocks"):
+            raw2 = extract_blocks(raw, events, trigger)
+        # written to a temporary file first, so that an interrupted
+        # conversion never leaves a partial recording
+        raw_file_name = raw_file_names[trigger]
+        tmp_file_name = raw_file_name.replace(
+            '-raw.fif', f'.{os.getpid()}.tmp-raw.fif')
+        with step("save"):
+            raw2.save(tmp_file_name, overwrite=True)
+            os.replace(tmp_file_name, raw_file_name)
+        index_recording(subject, cond_list[trigger])
 
-        raw_file_name = f'{folder}/{subject}_{cond_list[trigger]}-raw.fif'
-        if os.path.exists(raw_file_name):
-            continue
 
-        condA = mne.pick_events(events, trigger)
-        idx, = np.where(np.diff(condA[:, 0]) > 15000)
-        condB = np.vstack((condA[0], condA[idx + 1]))
-        epo = mne.Epochs(raw, condB, tmin=0, tmax=60, baseline=None)
-        epo.load_data()
+if __name__ == "__main__":
 
-        data = np.vstack(np.transpose(epo._data, [0, 2, 1])).T
-        raw2 = mne.io.RawArray(data, raw.info)
+    os.makedirs(new_data_DIR, exist_ok=True)
+    os.makedirs(data_DIR, exist_ok=True)
 
-        raw2.save(raw_file_name)
+    _, failures = run_parallel(process_1sub, get_subject_list())
+    report_failures(failures)
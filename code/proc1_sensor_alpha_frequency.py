@@ -1,63 +1,73 @@
 # %%
 """ Data: compute center frequency for each EEG subject."""
-import os
 import mne
 import numpy as np
-import pandas as pd
 import fooof
 
 from params import DATA_DIR, \
     SPEC_FMIN, SPEC_FMAX, \
-    SPEC_NR_SECONDS, SPEC_PARAM_DIR, \
+    SPEC_NR_SECONDS, \
     SPEC_NR_PEAKS, ALPHA_FMAX, ALPHA_FMIN
 from helper import get_participant_list
+from parallel import run_parallel, report_failures
+import results_store
+from spectral_cache import load_or_compute
+from raw_mmap import read_raw_mmap, average_signal
+from profiling import profile_task, step
 
 
+@profile_task
 def process_1sub(subject, condition):
-    os.makedirs(SPEC_PARAM_DIR, exist_ok=True)
-    spec_file = f"{SPEC_PARAM_DIR}/{subject}_{condition}.csv"
-
     file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
-    raw = mne.io.read_raw_fif(file_name, preload=True)
-    raw.set_eeg_reference("average")
 
     if subject == "sub-032478":
         # this participants has potentially wrong-labeled channel names
         return
 
-    # pick midline channels
-    raw.pick_types(eeg=True)
-    midline_channels = [ch for ch in raw.ch_names if "z" in ch]
-    raw.pick_channels(midline_channels)
-    front_channels = [ch for ch in raw.ch_names if "F" in ch]
-    raw.drop_channels(front_channels)
-
-    # compute PSD
-    psd, freqs = mne.time_frequency.psd_welch(
-        raw,
-        fmin=SPEC_FMIN,
-        fmax=SPEC_FMAX,
-        n_fft=int(SPEC_NR_SECONDS * raw.info["sfreq"]),
-        n_overlap=raw.info["sfreq"],
-    )
+    def compute_psd():
+        with step("read"):
+            raw = read_raw_mmap(subject, condition)
+            raw.pick_types(eeg=True)
+
+            # average reference, computed chunk-wise from the memory map
+            average = average_signal(raw)
+
+            # pick midline channels
+            midline_channels = [ch for ch in raw.ch_names if "z" in ch]
+            channels = [ch for ch in midline_channels if "F" not in ch]
+            data = raw.get_data(picks=channels) - average
+
+        # compute PSD
+        with step("welch"):
+            psd, freqs = mne.time_frequency.psd_array_welch(
+                data,
+                raw.info["sfreq"],
+                fmin=SPEC_FMIN,
+                fmax=SPEC_FMAX,
+                n_fft=int(SPEC_NR_SECONDS * raw.info["sfreq"]),
+                n_overlap=raw.info["sfreq"],
+            )
+        return dict(psd=psd, freqs=freqs, ch_names=channels)
+
+    key = dict(subject=subject, condition=condition, reference="average",
+               channels="midline-nonfrontal", fmin=SPEC_FMIN, fmax=SPEC_FMAX,
+               nr_seconds=SPEC_NR_SECONDS, overlap_seconds=1)
+    with step("psd"):
+        spectra = load_or_compute("psd_welch", key, compute_psd, [file_name])
+    psd, freqs = spectra["psd"], spectra["freqs"]
 
     # fit spec param
-    fm = fooof.FOOOFGroup(max_n_peaks=SPEC_NR_PEAKS)
-    fm.fit(freqs, psd)
+    with step("fooof"):
+        fm = fooof.FOOOFGroup(max_n_peaks=SPEC_NR_PEAKS)
+        fm.fit(freqs, psd)
     alpha_bands = fooof.analysis.get_band_peak_fg(fm, [ALPHA_FMIN, ALPHA_FMAX])
 
     peak = np.nanmean(alpha_bands[:, 0])
     amp = np.nanmean(alpha_bands[:, 1])
-    rsq = np.mean([fm.get_results()[i][2] for i in range(len(raw.ch_names))])
+    rsq = np.mean([fm.get_results()[i][2] for i in range(len(psd))])
 
-    # create dataframe with data
-    df_subject = pd.Series(
-        data={"subject": subject,
-              "peak_frequency": peak,
-              "peak_amplitude": amp,
-              'rsq': rsq}
-    )
-    df_subject.to_csv(spec_file)
+    results_store.write_row('sensor_param', subject, condition,
+                            peak_frequency=peak, peak_amplitude=amp, rsq=rsq)
 
     return peak
 
@@ -65,8 +75,9 @@ def process_1sub(subject, condition):
 # %%
 if __name__ == "__main__":
 
-    for condition in ['eo', 'ec']:
-        subjects = get_participant_list('data', condition)
-        for subject in subjects:
-            peak = process_1sub(subject, condition)
-            print(subject, peak)
+    tasks = [(subject, condition) for condition in ['eo', 'ec']
+             for subject in get_participant_list('data', condition)]
+    peaks, failures = run_parallel(process_1sub, tasks)
+    for (subject, condition), peak in sorted(peaks.items()):
+        print(subject, condition, peak)
+    report_failures(failures)
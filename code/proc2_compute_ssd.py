@@ -1,33 +1,38 @@
 # %%
 """ Data: compute SSD filters for all subjects and save them.
+
+With --sweep, SSD is computed for candidate peaks across the alpha band
+from one cached cross-spectral density per subject, and the filters at the
+peak with the highest SNR are kept instead of those at the sensor-space
+alpha peak.
 """
-import pandas as pd
-import mne
 import numpy as np
 import os
+import argparse
 import ssd
 from helper import get_participant_list
-from params import DATA_DIR, SSD_DIR, SPEC_PARAM_DIR, SSD_WIDTH, \
-    SNR_THRESHOLD
+from parallel import run_parallel, report_failures
+import results_store
+from raw_mmap import read_raw_mmap
+from profiling import profile_task, step
+from params import DATA_DIR, SSD_DIR, CSD_DIR, SSD_WIDTH, SNR_THRESHOLD, \
+    ALPHA_FMIN, ALPHA_FMAX
 
 # %% specify participants and folders
 os.makedirs(SSD_DIR, exist_ok=True)
 
 
-def process_1sub(subject, condition):
+@profile_task
+def process_1sub(subject, condition, sweep=False):
 
-    ssd_filters_fname = f"{SSD_DIR}/{subject}_ssd_filters_{condition}.csv"
     raw_ssd_file = f'{SSD_DIR}/{subject}_{condition}_raw.fif'
 
-    spec_file = f"{SPEC_PARAM_DIR}/{subject}_{condition}.csv"
-    df = pd.read_csv(spec_file, index_col=0)
-    peak_alpha = df.T['peak_frequency'].to_numpy('float32')[0]
-    peak_amp = df.T['peak_amplitude'].to_numpy('float32')[0]
+    sensor_param = results_store.read_row('sensor_param', subject, condition)
+    peak_alpha = np.float32(sensor_param['peak_frequency'])
+    peak_amp = np.float32(sensor_param['peak_amplitude'])
 
-    # load data
-    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
-    raw = mne.io.read_raw_fif(file_name)
-    raw.load_data()
+    # data is streamed from the memory map for computing the covariances
+    raw = read_raw_mmap(subject, condition)
     raw.pick_types(eeg=True)
     raw.set_montage('standard_1020')
 
@@ -36,28 +41,73 @@ def process_1sub(subject, condition):
     if peak_amp < SNR_THRESHOLD:
         return
 
-    print(f'running SSD with peak: {peak_alpha} Hz')
-    filters, patterns = ssd.run_ssd(raw, peak=peak_alpha,
-                                    band_width=SSD_WIDTH)
+    if sweep:
+        with step("csd"):
+            csd = ssd.load_or_compute_csd(
+                raw, f"{CSD_DIR}/{subject}_{condition}-csd.npz",
+                source_files=[f"{DATA_DIR}/{subject}_{condition}-raw.fif"])
+        with step("ssd"):
+            peaks = np.arange(ALPHA_FMIN, ALPHA_FMAX + 0.01, 0.25)
+            _, best_peak, filters, patterns = ssd.ssd_sweep(
+                raw, peaks, SSD_WIDTH, csd=csd)
+        print(f'SSD sweep: best peak {best_peak} Hz, '
+              f'sensor peak {peak_alpha} Hz')
+    else:
+        print(f'running SSD with peak: {peak_alpha} Hz')
+        with step("ssd"):
+            filters, patterns = ssd.run_ssd(raw, peak=peak_alpha,
+                                            band_width=SSD_WIDTH)
 
-    df_filters = pd.DataFrame(filters.T, columns=raw.ch_names)
-    df_filters.to_csv(ssd_filters_fname, index=False)
+    nr_components = 4
+    with step("apply_filters"):
+        raw_ssd = ssd.apply_filters(raw, filters[:, :nr_components])
 
-    df_patterns = pd.DataFrame(patterns.T, columns=raw.ch_names)
-    ssd_patterns_fname = f"{SSD_DIR}/{subject}_ssd_patterns_{condition}.csv"
-    df_patterns.to_csv(ssd_patterns_fname, index=False)
+    with step("save"):
+        raw_ssd.save(raw_ssd_file, overwrite=True)
 
-    nr_components = 4
-    raw_ssd = ssd.apply_filters(raw, filters[:, :nr_components])
-    raw_ssd.save(raw_ssd_file, overwrite=True)
+        # written last, marks the subject as done for the following steps
+        results_store.write_ssd(subject, condition, filters, patterns,
+                                raw.ch_names)
 
     return
 
 
+@profile_task
+def project_1sub(subject, condition, nr_components=4):
+    """Recompute the SSD components of a subject from the stored filters."""
+
+    raw_ssd_file = f'{SSD_DIR}/{subject}_{condition}_raw.fif'
+    filters, _, ch_names = results_store.read_ssd(subject, condition)
+
+    raw = read_raw_mmap(subject, condition)
+    raw.pick_channels(ch_names, ordered=True)
+
+    with step("apply_filters"):
+        raw_ssd = ssd.apply_filters(raw, filters[:, :nr_components])
+    with step("save"):
+        raw_ssd.save(raw_ssd_file, overwrite=True)
+
+
 if __name__ == "__main__":
 
-    for condition in ['eo', 'ec']:
-        subjects = get_participant_list('sensor_param', condition)
-        for subject in subjects:
-            process_1sub(subject, condition)
-            print(subject)
+    parser = argparse.ArgumentParser(
+        description="compute SSD filters for all subjects")
+    parser.add_argument('--project-only', action='store_true',
+                        help="only recompute the components from the "
+                             "filters in the results store")
+    parser.add_argument('--sweep', action='store_true',
+                        help="use the peak with the highest SNR across "
+                             "the alpha band instead of the sensor peak")
+    args = parser.parse_args()
+
+    if args.project_only:
+        tasks = [(subject, condition) for condition in ['eo', 'ec']
+                 for subject in get_participant_list('ssd', condition)]
+        _, failures = run_parallel(project_1sub, tasks)
+    else:
+        tasks = [(subject, condition, args.sweep)
+                 for condition in ['eo', 'ec']
+                 for subject in get_participant_list('sensor_param',
+                                                     condition)]
+        _, failures = run_parallel(process_1sub, tasks)
+    report_failures(failures)
@@ -0,0 +1,157 @@
+# %%
+""" Data: alpha-beta power coupling for all channels of each subject.
+
+Whole-head version of the C3 analysis in fig2b: for every EEG channel
+(average reference), segment PSDs are sorted by beta power into percentile
+spectra, which are 1/f-corrected, and the Spearman correlation of alpha and
+beta power across the percentile lines is computed. The segment FFTs, the
+aperiodic fits and the rank correlations are each computed for all channels
+at once. Results are compiled into a subjects x channels csv-file.
+
+The 1/f-correction uses FOOOF as in fig2b, or with --aperiodic linear a
+vectorized fit without peaks, which takes milliseconds instead of about half
+a minute per subject but deviates slightly from the FOOOF fits.
+
+Usage: python proc4_sensor_coupling.py [--aperiodic {fooof,linear}]
+"""
+import argparse
+import numpy as np
+import pandas as pd
+
+from params import CSV_DIR, SPEC_NR_SECONDS, ALPHA_FMIN, ALPHA_FMAX, \
+    BETA_FMIN, BETA_FMAX
+from helper import get_participant_list, _segment_spectra, \
+    sort_percentiles, fit_aperiodic, fit_aperiodic_linear
+from parallel import run_parallel, report_failures
+import results_store
+import stats
+from raw_mmap import read_raw_mmap, average_signal
+from profiling import profile_task, step
+
+conditions = ['eo', 'ec']
+nr_lines = 20
+
+
+def average_reference_spectra(raw, nr_seconds=SPEC_NR_SECONDS,
+                              nr_segments_chunk=20):
+    """Segment PSDs of all channels with average reference, read chunk-wise.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Recording, does not need to be preloaded.
+    nr_seconds : int
+        Segment length in seconds.
+    nr_segments_chunk : int
+        Number of segments read from the recording at once.
+
+    Returns
+    -------
+    psd : array, shape (channels, segments, n_freqs)
+        Segment PSDs.
+    freq : array
+        Frequency axis of the PSDs.
+    """
+
+    sfreq = raw.info['sfreq']
+    n_fft = nr_seconds * int(sfreq)
+    n_segments = (raw.n_times - 1) // n_fft
+    average = average_signal(raw)
+
+    psd = []
+    for start in range(0, n_segments, nr_segments_chunk):
+        stop = min(start + nr_segments_chunk, n_segments)
+        # one extra sample, so that the last segment of the chunk is complete
+        data = raw.get_data(start=start * n_fft, stop=stop * n_fft + 1)
+        data -= average[start * n_fft:stop * n_fft + 1]
+        psd_chunk, freq = _segment_spectra(data, sfreq, nr_seconds)
+        psd.append(psd_chunk)
+
+    return np.concatenate(psd, axis=1), freq
+
+
+def alpha_beta_coupling(psd, freq, nr_lines=nr_lines, aperiodic='fooof'):
+    """Spearman correlation of alpha and beta power across percentile lines.
+
+    Parameters
+    ----------
+    psd : array, shape (channels, segments, n_freqs)
+        Segment PSDs.
+    freq : array
+        Frequency axis of the PSDs.
+    nr_lines : int
+        Number of percentile lines, sorted by beta power.
+    aperiodic : str
+        Fit of the 1/f-component, 'fooof' or 'linear' (see
+        helper.fit_aperiodic_linear).
+
+    Returns
+    -------
+    corr, corr_p : array, shape (channels,)
+        Correlation coefficients and p-values per channel.
+    """
+
+    band = [BETA_FMIN, BETA_FMAX]
+    psd_perc = sort_percentiles(psd, freq, band, nr_lines)
+
+    # 1/f-correction of all percentile spectra of all channels at once
+    spectra = psd_perc.reshape(-1, len(freq))
+    if aperiodic == 'linear':
+        ap_fit, _ = fit_aperiodic_linear(freq, spectra)
+    else:
+        ap_fit, _ = fit_aperiodic(freq, spectra)
+    psd_corr = np.log10(psd_perc) - ap_fit.reshape(psd_perc.shape)
+
+    idx_beta = (freq > band[0]) & (freq < band[1])
+    idx_alpha = (freq > ALPHA_FMIN) & (freq < ALPHA_FMAX)
+    beta = np.mean(psd_corr[:, :, idx_beta], axis=2)
+    alpha = np.mean(psd_corr[:, :, idx_alpha], axis=2)
+
+    return stats.spearman(alpha, beta)
+
+
+@profile_task
+def process_1sub(subject, condition, aperiodic='fooof'):
+
+    raw = read_raw_mmap(subject, condition)
+    raw.pick_types(eeg=True)
+
+    with step("segment_spectra"):
+        psd, freq = average_reference_spectra(raw)
+    with step("coupling"):
+        corr, corr_p = alpha_beta_coupling(psd, freq, aperiodic=aperiodic)
+
+    results_store.write_coupling(subject, condition, corr, corr_p,
+                                 raw.ch_names)
+
+
+def compile_results(condition):
+    """Export the correlations of all subjects as subjects x channels."""
+
+    corr = dict()
+    for subject in results_store.get_subjects('sensor_coupling', condition):
+        corr_sub, _, ch_names = results_store.read_coupling(subject,
+                                                            condition)
+        corr[subject] = pd.Series(corr_sub, index=ch_names)
+
+    # channels missing for a subject are left empty
+    df = pd.DataFrame.from_dict(corr, orient='index')
+    df.index.name = 'subject'
+    df.to_csv(f'{CSV_DIR}/sensor_coupling_{condition}.csv')
+
+
+# %% compute for all participants
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--aperiodic', choices=['fooof', 'linear'],
+                        default='fooof')
+    args = parser.parse_args()
+
+    tasks = [(subject, condition, args.aperiodic) for condition in conditions
+             for subject in get_participant_list('data', condition)]
+    _, failures = run_parallel(process_1sub, tasks)
+    report_failures(failures)
+
+    for condition in conditions:
+        compile_results(condition)
@@ -0,0 +1,141 @@
+# %%
+""" Data: phase coupling of alpha and harmonic beta on the SSD components.
+
+For each stored SSD component of each subject, the 1:2 phase-locking value
+between the alpha peak and twice the alpha peak and the bicoherence at
+(peak, peak) are computed. Both come from one FFT of all segments of the
+components: the bicoherence from the Hann-windowed segment spectra at the
+peak and harmonic bins, the phase-locking value from narrow-band analytic
+signals obtained by weighting the positive frequencies of the segment
+spectra around peak and harmonic and transforming back. Results are written
+to the results store and compiled into one csv-file per condition, with one
+row per subject and component.
+"""
+import mne
+import numpy as np
+import pandas as pd
+
+from params import CSV_DIR, SSD_DIR, SSD_WIDTH, SPEC_NR_SECONDS
+from helper import get_participant_list
+from parallel import run_parallel, report_failures
+import results_store
+from profiling import profile_task, step
+
+conditions = ['eo', 'ec']
+
+
+def phase_coupling(data, sfreq, peak, band_width=SSD_WIDTH,
+                   nr_seconds=SPEC_NR_SECONDS, trim=0.5):
+    """1:2 phase-locking value and bicoherence of alpha and harmonic beta.
+
+    Parameters
+    ----------
+    data : array, shape (channels, n_times)
+        Signals, e.g. SSD components.
+    sfreq : float
+        Sampling frequency.
+    peak : float
+        Alpha peak frequency.
+    band_width : float
+        Standard deviation in Hz of the Gaussian frequency weighting used
+        for the analytic signals.
+    nr_seconds : int
+        Segment length in seconds.
+    trim : float
+        Duration in seconds discarded at both ends of each segment for the
+        phase-locking value, where the analytic signals wrap around.
+
+    Returns
+    -------
+    plv : array, shape (channels,)
+        Phase-locking value of twice the alpha phase and the beta phase.
+    bicoherence : array, shape (channels,)
+        Bicoherence at the frequency pair (peak, peak).
+    """
+
+    n_fft = nr_seconds * int(sfreq)
+    n_channels, n_times = data.shape
+    n_segments = n_times // n_fft
+
+    segments = data[:, :n_segments * n_fft].reshape(n_channels, n_segments,
+                                                    n_fft)
+    segments = segments - segments.mean(axis=-1, keepdims=True)
+    spectra = np.fft.fft(segments, axis=-1)
+    freq = np.fft.fftfreq(n_fft, 1 / sfreq)
+
+    # Hann-windowed spectra at the peak and harmonic bins, from the
+    # unwindowed ones: the window is a convolution with three bins
+    def windowed(k):
+        return 0.5 * spectra[..., k] - 0.25 * (spectra[..., k - 1] +
+                                               spectra[..., k + 1])
+
+    idx_peak = int(round(peak * n_fft / sfreq))
+    alpha = windowed(idx_peak)
+    beta = windowed(2 * idx_peak)
+    bispectrum = np.mean(alpha * alpha * np.conj(beta), axis=-1)
+    bicoherence = np.abs(bispectrum) / np.sqrt(
+        np.mean(np.abs(alpha * alpha) ** 2, axis=-1) *
+        np.mean(np.abs(beta) ** 2, axis=-1))
+
+    # analytic signals: positive frequencies only, Gaussian around the bands
+    def analytic(center):
+        weights = 2 * np.exp(-0.5 * ((freq - center) / band_width) ** 2)
+        weights[freq <= 0] = 0
+        return np.fft.ifft(spectra * weights, axis=-1)
+
+    n_trim = int(trim * sfreq)
+    alpha = analytic(peak)[..., n_trim:n_fft - n_trim]
+    beta = analytic(2 * peak)[..., n_trim:n_fft - n_trim]
+    alpha_phase = alpha / np.abs(alpha)
+    beta_phase = beta / np.abs(beta)
+    plv = np.abs(np.mean(alpha_phase ** 2 * np.conj(beta_phase),
+                         axis=(1, 2)))
+
+    return plv, bicoherence
+
+
+@profile_task
+def process_1sub(subject, condition):
+
+    ssd_param = results_store.read_row('ssd_param', subject, condition)
+    peak = ssd_param['alpha_peak']
+    if peak is None or np.isnan(peak):
+        return
+
+    raw_ssd = mne.io.read_raw_fif(f'{SSD_DIR}/{subject}_{condition}_raw.fif')
+    data = raw_ssd.get_data()
+
+    with step("phase_coupling"):
+        plv, bicoherence = phase_coupling(data, raw_ssd.info['sfreq'], peak)
+
+    results_store.write_phase_coupling(subject, condition, peak, plv,
+                                       bicoherence)
+
+
+def compile_results(condition):
+    """Export the results of all subjects and components into one csv-file."""
+
+    rows = []
+    for subject in results_store.get_subjects('phase_coupling', condition):
+        peak, plv, bicoherence = results_store.read_phase_coupling(
+            subject, condition)
+        for i_comp in range(len(plv)):
+            rows.append(dict(subject=subject, component=i_comp + 1,
+                             alpha_peak=peak, plv=plv[i_comp],
+                             bicoherence=bicoherence[i_comp]))
+
+    df = pd.DataFrame(rows, columns=['subject', 'component', 'alpha_peak',
+                                     'plv', 'bicoherence'])
+    df.to_csv(f'{CSV_DIR}/phase_coupling_{condition}.csv', index=False)
+
+
+# %% compute for all participants
+if __name__ == "__main__":
+
+    tasks = [(subject, condition) for condition in conditions
+             for subject in get_participant_list('ssd_param', condition)]
+    _, failures = run_parallel(process_1sub, tasks)
+    report_failures(failures)
+
+    for condition in conditions:
+        compile_results(condition)
@@ -0,0 +1,128 @@
+""" Timing and memory instrumentation of the processing steps.
+
+Profiling is switched on by setting the environment variable EEG_PROFILE,
+e.g. EEG_PROFILE=1 python proc2_compute_ssd.py. Each processing function
+decorated with profile_task and each step wrapped in `with step(name)`
+then appends a record with wall time, CPU time and peak resident memory to
+a json-lines log in PROFILE_DIR, together with the task (subject and
+condition) it belongs to. When switched off, profile_task returns the
+function unchanged and step returns a shared context that does nothing.
+
+Usage: python profiling.py [--nr-rows N]  (summary of the log)
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import functools
+import contextlib
+
+from params import PROFILE_DIR
+
+ENABLED = os.environ.get('EEG_PROFILE', '') not in ('', '0')
+PROFILE_FILE = f"{PROFILE_DIR}/profile.jsonl"
+
+_NULL_STEP = contextlib.nullcontext()
+_state = dict(task=None, steps=[])
+
+
+def _max_rss_mb():
+    """Peak resident memory of the process so far in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, in kilobytes on Linux
+    return max_rss / 1e6 if sys.platform == 'darwin' else max_rss / 1e3
+
+
+def _write(record):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # a single short write in append mode, so parallel workers can share
+    # the log without interleaving lines
+    with open(PROFILE_FILE, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@contextlib.contextmanager
+def _profile_step(name):
+    _state['steps'].append(name)
+    path = '/'.join(_state['steps'])
+    rss_start = _max_rss_mb()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        max_rss = _max_rss_mb()
+        _state['steps'].pop()
+        _write(dict(task=_state['task'], step=path, depth=path.count('/'),
+                    wall=wall, cpu=cpu, max_rss=max_rss,
+                    rss_increase=max_rss - rss_start, pid=os.getpid(),
+                    time=time.time()))
+
+
+def step(name):
+    """Context manager recording the duration and memory of a step."""
+
+    if not ENABLED:
+        return _NULL_STEP
+    return _profile_step(name)
+
+
+def profile_task(func):
+    """Decorator recording a processing function per task.
+
+    The arguments of the function, e.g. subject and condition, identify
+    the task of all steps executed within the function.
+    """
+
+    if not ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous_task = _state['task']
+        _state['task'] = '|'.join(
+            [str(arg) for arg in args] +
+            [f"{key}={value}" for key, value in kwargs.items()])
+        try:
+            with _profile_step(f"{func.__module__}.{func.__name__}"):
+                return func(*args, **kwargs)
+        finally:
+            _state['task'] = previous_task
+
+    return wrapper
+
+
+def summary(nr_rows=10):
+    """Print the slowest tasks and the total time spent per step."""
+
+    import pandas as pd
+
+    df = pd.read_json(PROFILE_FILE, lines=True)
+
+    # steps called outside of a processing function have no task
+    is_task = (df.depth == 0) & df.task.notna()
+    tasks = df[is_task].sort_values('wall', ascending=False)
+    print(f"slowest of {len(tasks)} tasks")
+    print(tasks[['step', 'task', 'wall', 'cpu', 'max_rss']]
+          .head(nr_rows).to_string(index=False, float_format='%.2f'))
+
+    steps = df[~is_task].groupby('step').agg(
+        count=('wall', 'size'), wall=('wall', 'sum'),
+        wall_mean=('wall', 'mean'), cpu=('cpu', 'sum'),
+        rss_increase=('rss_increase', 'max'))
+    steps['fraction'] = steps.wall / tasks.wall.sum()
+    print("\nsteps by total wall time")
+    print(steps.sort_values('wall', ascending=False).head(nr_rows)
+          .to_string(float_format='%.2f'))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nr-rows', type=int, default=10)
+    args = parser.parse_args()
+    summary(args.nr_rows)
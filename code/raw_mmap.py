@@ -0,0 +1,184 @@
+""" Memory-mapped access to the EEG recordings.
+
+Each FIF-file is converted once into a float32 .npy-file of shape
+(channels, samples) with a json-sidecar holding channel names and types,
+sampling frequency, montage and annotations. read_raw_mmap returns a Raw
+instance that is not preloaded: get_data and the chunk-wise computations
+(e.g. ssd.compute_ssd, helper.percentile_spectrum) only read the requested
+channels and samples from the memory map, so many subjects can be
+processed concurrently without holding the recordings in memory.
+"""
+import os
+import json
+import numpy as np
+import mne
+from mne.io import BaseRaw
+from mne.io.utils import _mult_cal_one
+
+from params import DATA_DIR, MMAP_DIR
+
+
+def get_mmap_files(subject, condition):
+    """Return the names of the data and the header file of a recording."""
+
+    base_name = f"{MMAP_DIR}/{subject}_{condition}"
+    return f"{base_name}-raw.npy", f"{base_name}-raw.json"
+
+
+def _source_stamp(file_name):
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def convert_to_mmap(subject, condition, chunk_duration=60.0):
+    """Convert a FIF-file into a memory-mappable array and a header.
+
+    Parameters
+    ----------
+    subject : str
+        Subject ID.
+    condition : str
+        Condition, 'eo' or 'ec'.
+    chunk_duration : float
+        Duration in seconds of the data converted at once.
+    """
+
+    os.makedirs(MMAP_DIR, exist_ok=True)
+    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
+    data_file, header_file = get_mmap_files(subject, condition)
+
+    raw = mne.io.read_raw_fif(file_name)
+    n_chunk = int(chunk_duration * raw.info['sfreq'])
+
+    # written to temporary files first, a header marks a complete conversion
+    tmp_data_file = f"{data_file[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    data = np.lib.format.open_memmap(
+        tmp_data_file, mode='w+', dtype='float32',
+        shape=(len(raw.ch_names), raw.n_times))
+    for start in range(0, raw.n_times, n_chunk):
+        stop = min(start + n_chunk, raw.n_times)
+        data[:, start:stop] = raw.get_data(start=start, stop=stop)
+    data.flush()
+    del data
+    os.replace(tmp_data_file, data_file)
+
+    montage = raw.get_montage()
+    if montage is not None:
+        positions = montage.get_positions()
+        montage = dict(
+            ch_pos={ch: list(pos) for ch, pos in positions['ch_pos'].items()},
+            coord_frame=positions['coord_frame'])
+
+    # onsets relative to the first sample
+    annotations = raw.annotations
+    onset = annotations.onset
+    if annotations.orig_time is not None:
+        onset = onset - raw.first_time
+
+    header = dict(
+        ch_names=raw.ch_names,
+        ch_types=raw.get_channel_types(),
+        sfreq=raw.info['sfreq'],
+        highpass=raw.info['highpass'],
+        lowpass=raw.info['lowpass'],
+        montage=montage,
+        annotations=dict(onset=list(onset),
+                         duration=list(annotations.duration),
+                         description=list(annotations.description)),
+        source=_source_stamp(file_name))
+
+    tmp_header_file = f"{header_file}.{os.getpid()}.tmp"
+    with open(tmp_header_file, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_header_file, header_file)
+
+
+class RawMemmap(BaseRaw):
+    """Raw instance reading its data from a memory-mapped array."""
+
+    def __init__(self, data_file, header):
+
+        info = mne.create_info(header['ch_names'], header['sfreq'],
+                               header['ch_types'])
+        with info._unlock():
+            info['highpass'] = header['highpass']
+            info['lowpass'] = header['lowpass']
+
+        n_times = np.load(data_file, mmap_mode='r').shape[1]
+        super().__init__(info, preload=False, last_samps=(n_times - 1,),
+                         filenames=(data_file,), orig_format='single')
+
+        if header['montage'] is not None:
+            self.set_montage(mne.channels.make_dig_montage(
+                ch_pos=header['montage']['ch_pos'],
+                coord_frame=header['montage']['coord_frame']))
+        self.set_annotations(mne.Annotations(**header['annotations']))
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        """Read a chunk of raw data."""
+        # opened per chunk, so copies of the instance do not copy the data
+        data_mmap = np.load(self._filenames[fi], mmap_mode='r')
+        if mult is None:
+            # only the requested channels are read from the memory map
+            block = data_mmap[idx, start:stop]
+            idx = slice(None)
+        else:
+            block = data_mmap[:, start:stop]
+        _mult_cal_one(data, block, idx, cals, mult)
+
+
+def read_raw_mmap(subject, condition):
+    """Return a memory-mapped Raw instance of a recording.
+
+    The recording is converted first if this was not done yet or if the
+    FIF-file changed since the conversion.
+
+    Parameters
+    ----------
+    subject : str
+        Subject ID.
+    condition : str
+        Condition, 'eo' or 'ec'.
+
+    Returns
+    -------
+    raw : instance of RawMemmap
+        Raw instance, which is not preloaded.
+    """
+
+    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
+    data_file, header_file = get_mmap_files(subject, condition)
+
+    header = None
+    if os.path.exists(header_file):
+        with open(header_file) as f:
+            header = json.load(f)
+    if header is None or header['source'] != _source_stamp(file_name):
+        convert_to_mmap(subject, condition)
+        with open(header_file) as f:
+            header = json.load(f)
+
+    return RawMemmap(data_file, header)
+
+
+def average_signal(raw, chunk_duration=10.0):
+    """Mean over all channels of a Raw instance, computed chunk-wise."""
+
+    n_chunk = int(chunk_duration * raw.info['sfreq'])
+    average = np.zeros(raw.n_times)
+    for start in range(0, raw.n_times, n_chunk):
+        stop = min(start + n_chunk, raw.n_times)
+        average[start:stop] = raw.get_data(start=start, stop=stop).mean(0)
+
+    return average
+
+
+if __name__ == "__main__":
+
+    from helper import get_participant_list
+    from parallel import run_parallel, report_failures
+
+    tasks = [(subject, condition) for condition in ['eo', 'ec']
+             for subject in get_participant_list('data', condition)]
+    _, failures = run_parallel(convert_to_mmap, tasks)
+    report_failures(failures)
@@ -0,0 +1,361 @@
+""" Results store: one SQLite database for all per-subject results.
+
+Sensor and SSD spectral parameters are tables with one row per subject and
+condition; SSD filters and patterns are stored as arrays together with the
+channel names. Each write is a single transaction replacing the row of a
+subject, so parallel workers can write concurrently and an interrupted
+worker never leaves a partial result. Reading a table for one condition is
+one query instead of opening a file per subject.
+
+The participant index records which artifacts (recordings and results) are
+available per subject and condition, with checksum and time of the last
+update. It is updated together with every write and is kept in memory for
+lookups until another process changes the database.
+"""
+import os
+import io
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+from params import RESULTS_DB, SPEC_PARAM_DIR, SSD_PARAM_DIR, SSD_DIR
+
+TABLES = {
+    'sensor_param': dict(peak_frequency='REAL', peak_amplitude='REAL',
+                         rsq='REAL'),
+    'ssd_param': dict(alpha_peak='REAL', beta_peak='REAL'),
+    'ssd_filters': dict(ch_names='TEXT', filters='BLOB', patterns='BLOB'),
+    'sensor_coupling': dict(ch_names='TEXT', corr='BLOB', corr_p='BLOB'),
+    'phase_coupling': dict(alpha_peak='REAL', plv='BLOB', bicoherence='BLOB'),
+}
+
+# aspect of the participant index, as used by get_participant_list
+ASPECTS = dict(sensor_param='sensor_param', ssd_filters='ssd',
+               ssd_param='ssd_param', sensor_coupling='sensor_coupling',
+               phase_coupling='phase_coupling')
+
+_index = dict(pid=None, con=None, version=None, subjects=None)
+
+
+def connect():
+    """Open the database, creating tables that do not exist yet."""
+
+    os.makedirs(os.path.dirname(RESULTS_DB), exist_ok=True)
+    con = sqlite3.connect(RESULTS_DB, timeout=60)
+    # readers are not blocked by a worker that is writing
+    con.execute('PRAGMA journal_mode=WAL')
+    for table, columns in TABLES.items():
+        definition = ', '.join(f"{name} {sql_type}"
+                               for name, sql_type in columns.items())
+        con.execute(f"CREATE TABLE IF NOT EXISTS {table} (subject TEXT, "
+                    f"condition TEXT, {definition}, "
+                    "PRIMARY KEY (subject, condition))")
+    con.execute("CREATE TABLE IF NOT EXISTS participant_index (subject TEXT, "
+                "condition TEXT, aspect TEXT, checksum TEXT, size INTEGER, "
+                "mtime_ns INTEGER, updated REAL, "
+                "PRIMARY KEY (subject, condition, aspect))")
+    return con
+
+
+def _to_blob(array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _from_blob(blob):
+    return np.load(io.BytesIO(blob), allow_pickle=False)
+
+
+def _set_index(con, subject, condition, aspect, checksum, size=None,
+               mtime_ns=None):
+    con.execute("INSERT OR REPLACE INTO participant_index VALUES "
+                "(?, ?, ?, ?, ?, ?, ?)", (subject, condition, aspect,
+                                          checksum, size, mtime_ns,
+                                          time.time()))
+
+
+def _read_row(con, table, subject, condition):
+    cursor = con.execute(f"SELECT * FROM {table} WHERE subject = ? "
+                         "AND condition = ?", (subject, condition))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([description[0] for description in cursor.description],
+                    row))
+
+
+def _digest(row):
+    return hashlib.sha256(repr(sorted(row.items())).encode()).hexdigest()
+
+
+def write_row(table, subject, condition, **values):
+    """Insert or replace the results of one subject and condition."""
+
+    columns = ['subject', 'condition'] + list(TABLES[table])
+    row = [subject, condition] + [values[name] for name in TABLES[table]]
+    con = connect()
+    try:
+        with con:
+            con.execute(f"INSERT OR REPLACE INTO {table} "
+                        f"({', '.join(columns)}) VALUES "
+                        f"({', '.join('?' * len(columns))})", row)
+            checksum = _digest(_read_row(con, table, subject, condition))
+            _set_index(con, subject, condition, ASPECTS[table], checksum)
+    finally:
+        con.close()
+
+
+def read_row(table, subject, condition):
+    """Return the results of one subject and condition as dict or None."""
+
+    con = connect()
+    try:
+        row = _read_row(con, table, subject, condition)
+    finally:
+        con.close()
+    return row
+
+
+def read_table(table, condition):
+    """Return the results of all subjects for one condition."""
+
+    import pandas as pd
+
+    con = connect()
+    try:
+        df = pd.read_sql_query(f"SELECT * FROM {table} WHERE condition = ? "
+                               "ORDER BY subject", con, params=(condition,))
+    finally:
+        con.close()
+
+    # missing values are stored as NULL, keep numeric columns float
+    real_columns = {name: 'float' for name, sql_type in TABLES[table].items()
+                    if sql_type == 'REAL'}
+    return df.astype(real_columns)
+
+
+def get_subjects(table, condition):
+    """Return the sorted subjects with results for one condition."""
+
+    con = connect()
+    try:
+        rows = con.execute(f"SELECT subject FROM {table} WHERE condition = ? "
+                           "ORDER BY subject", (condition,)).fetchall()
+    finally:
+        con.close()
+    return [subject for subject, in rows]
+
+
+def delete_row(table, subject, condition):
+    con = connect()
+    try:
+        with con:
+            con.execute(f"DELETE FROM {table} WHERE subject = ? AND "
+                        "condition = ?", (subject, condition))
+            con.execute("DELETE FROM participant_index WHERE subject = ? "
+                        "AND condition = ? AND aspect = ?",
+                        (subject, condition, ASPECTS[table]))
+    finally:
+        con.close()
+
+
+def row_digest(table, subject, condition):
+    """Content hash of one row, None if it does not exist."""
+
+    row = read_row(table, subject, condition)
+    if row is None:
+        return None
+    return _digest(row)
+
+
+def read_index(aspect=None):
+    """Return the participant index, optionally of one aspect only."""
+
+    import pandas as pd
+
+    query = "SELECT * FROM participant_index"
+    params = ()
+    if aspect is not None:
+        query += " WHERE aspect = ?"
+        params = (aspect,)
+
+    con = connect()
+    try:
+        df = pd.read_sql_query(query + " ORDER BY subject", con,
+                               params=params)
+    finally:
+        con.close()
+    return df
+
+
+def update_index(entries, aspect, conditions=None):
+    """Set the indexed files of one aspect, removing all other entries.
+
+    Parameters
+    ----------
+    entries : list of tuple
+        Entries (subject, condition, checksum, size, mtime_ns).
+    aspect : str
+        Aspect the entries are indexed as, e.g. 'data'.
+    conditions : list of str | None
+        Only replace the entries of these conditions, default: all.
+    """
+
+    con = connect()
+    try:
+        with con:
+            if conditions is None:
+                con.execute("DELETE FROM participant_index WHERE aspect = ?",
+                            (aspect,))
+            for condition in conditions or ():
+                con.execute("DELETE FROM participant_index WHERE aspect = ? "
+                            "AND condition = ?", (aspect, condition))
+            for subject, condition, checksum, size, mtime_ns in entries:
+                _set_index(con, subject, condition, aspect, checksum, size,
+                           mtime_ns)
+    finally:
+        con.close()
+
+
+def sync_index():
+    """Index stored results that are missing from the participant index."""
+
+    con = connect()
+    try:
+        with con:
+            for table, aspect in ASPECTS.items():
+                con.execute("DELETE FROM participant_index AS i WHERE "
+                            "aspect = ? AND NOT EXISTS (SELECT 1 FROM "
+                            f"{table} AS t WHERE t.subject = i.subject AND "
+                            "t.condition = i.condition)", (aspect,))
+                missing = con.execute(
+                    f"SELECT subject, condition FROM {table} AS t WHERE NOT "
+                    "EXISTS (SELECT 1 FROM participant_index AS i WHERE "
+                    "i.aspect = ? AND i.subject = t.subject AND "
+                    "i.condition = t.condition)", (aspect,)).fetchall()
+                for subject, condition in missing:
+                    checksum = _digest(_read_row(con, table, subject,
+                                                 condition))
+                    _set_index(con, subject, condition, aspect, checksum)
+    finally:
+        con.close()
+
+
+def get_indexed_subjects(aspect, condition):
+    """Return the set of subjects with an artifact of an aspect.
+
+    The index is kept in memory and only read again from the database if it
+    was changed by any connection since the last call.
+    """
+
+    # connections cannot be shared with forked worker processes
+    if _index['pid'] != os.getpid():
+        _index.update(pid=os.getpid(), con=connect(), version=None)
+
+    version = _index['con'].execute('PRAGMA data_version').fetchone()[0]
+    if version != _index['version']:
+        subjects = dict()
+        for row in _index['con'].execute(
+                "SELECT aspect, condition, subject FROM participant_index"):
+            subjects.setdefault(row[:2], set()).add(row[2])
+        _index.update(version=version, subjects=subjects)
+
+    return _index['subjects'].get((aspect, condition), set())
+
+
+def write_ssd(subject, condition, filters, patterns, ch_names):
+    """Store SSD filters and patterns, shape (channels, components)."""
+
+    write_row('ssd_filters', subject, condition,
+              ch_names=json.dumps(list(ch_names)),
+              filters=_to_blob(filters), patterns=_to_blob(patterns))
+
+
+def read_ssd(subject, condition):
+    """Return SSD filters, patterns and channel names of one subject."""
+
+    row = read_row('ssd_filters', subject, condition)
+    if row is None:
+        raise KeyError(f"no SSD results for {subject} {condition}")
+
+    return _from_blob(row['filters']), _from_blob(row['patterns']), \
+        json.loads(row['ch_names'])
+
+
+def write_coupling(subject, condition, corr, corr_p, ch_names):
+    """Store alpha-beta correlations and p-values, one per channel."""
+
+    write_row('sensor_coupling', subject, condition,
+              ch_names=json.dumps(list(ch_names)), corr=_to_blob(corr),
+              corr_p=_to_blob(corr_p))
+
+
+def read_coupling(subject, condition):
+    """Return correlations, p-values and channel names of one subject."""
+
+    row = read_row('sensor_coupling', subject, condition)
+    if row is None:
+        raise KeyError(f"no coupling results for {subject} {condition}")
+
+    return _from_blob(row['corr']), _from_blob(row['corr_p']), \
+        json.loads(row['ch_names'])
+
+
+def write_phase_coupling(subject, condition, alpha_peak, plv, bicoherence):
+    """Store phase-locking values and bicoherences, one per SSD component."""
+
+    write_row('phase_coupling', subject, condition, alpha_peak=alpha_peak,
+              plv=_to_blob(plv), bicoherence=_to_blob(bicoherence))
+
+
+def read_phase_coupling(subject, condition):
+    """Return alpha peak, phase-locking values and bicoherences of one
+    subject."""
+
+    row = read_row('phase_coupling', subject, condition)
+    if row is None:
+        raise KeyError(f"no phase coupling results for {subject} "
+                       f"{condition}")
+
+    return row['alpha_peak'], _from_blob(row['plv']), \
+        _from_blob(row['bicoherence'])
+
+
+def import_csv_results(conditions=('eo', 'ec')):
+    """Move results from the per-subject csv-files into the store."""
+
+    import pandas as pd
+
+    for condition in conditions:
+        for table, folder in [('sensor_param', SPEC_PARAM_DIR),
+                              ('ssd_param', SSD_PARAM_DIR)]:
+            if not os.path.isdir(folder):
+                continue
+            for file_name in sorted(os.listdir(folder)):
+                if not file_name.endswith(f"_{condition}.csv"):
+                    continue
+                df = pd.read_csv(f"{folder}/{file_name}", index_col=0)
+                values = df.iloc[:, 0]
+                subject = values.pop('subject')
+                write_row(table, subject, condition,
+                          **values.astype('float').to_dict())
+
+        if not os.path.isdir(SSD_DIR):
+            continue
+        suffix = f"_ssd_filters_{condition}.csv"
+        for file_name in sorted(os.listdir(SSD_DIR)):
+            if not file_name.endswith(suffix):
+                continue
+            subject = file_name[:-len(suffix)]
+            df_filters = pd.read_csv(f"{SSD_DIR}/{file_name}")
+            df_patterns = pd.read_csv(
+                f"{SSD_DIR}/{subject}_ssd_patterns_{condition}.csv")
+            write_ssd(subject, condition, df_filters.to_numpy().T,
+                      df_patterns.to_numpy().T, df_filters.columns)
+
+
+if __name__ == "__main__":
+    import_csv_results()
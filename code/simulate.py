@@ -0,0 +1,346 @@
+""" Simulation of multichannel EEG with alpha, harmonic beta and beta sources.
+
+Each simulated subject consists of alpha sources with a phase-locked
+harmonic at twice the alpha frequency, independent beta sources and
+aperiodic noise sources, projected to the channels of the 10-20 system
+through spatially smooth patterns, plus sensor noise. As in fig1a and fig2a,
+the oscillations are amplitude-modulated by power-law noise. The power-law
+noise of all sources is generated at once in the frequency domain.
+
+Subjects are simulated in parallel and streamed to disk in the format of
+raw_mmap (float32 .npy and json-header), together with the ground truth
+(frequencies and patterns of the sources), so that they can be processed
+like the recordings, e.g. with ssd.compute_ssd and
+helper.percentile_spectrum, without loading them into memory.
+
+Usage: python simulate.py folder [--subjects N] [--seconds S] [--validate]
+"""
+import os
+import json
+import zlib
+import argparse
+import numpy as np
+import mne
+
+from params import N_JOBS, SSD_WIDTH, SPEC_NR_SECONDS, ALPHA_FMIN, \
+    ALPHA_FMAX
+from parallel import run_parallel, report_failures
+
+# default parameters of a simulated subject, peak frequencies and
+# amplitudes are drawn per subject from the given ranges
+SIMULATION = dict(
+    nr_channels=62,
+    sfreq=500.0,
+    nr_seconds=300.0,
+    nr_alpha=2,
+    alpha_peak=(8.5, 12.0),
+    harmonic_amplitude=(0.0, 0.4),
+    nr_beta=1,
+    beta_peak=(16.0, 26.0),
+    beta_amplitude=0.25,
+    nr_noise=10,
+    noise_exponent=-2.0,
+    envelope_exponent=-1.5,
+    sensor_noise=0.5,
+    pattern_width=0.04,
+)
+
+
+def powerlaw_noise(nr_signals, nr_samples, sfreq, exponent, rng):
+    """Power-law noise with unit variance, shaped in the frequency domain.
+
+    Parameters
+    ----------
+    nr_signals : int
+        Number of signals.
+    nr_samples : int
+        Number of samples per signal.
+    sfreq : float
+        Sampling frequency.
+    exponent : float | array, shape (nr_signals,)
+        Power-law exponent of the power spectrum, P(f) ~ f ** exponent.
+    rng : instance of numpy.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    noise : array, shape (nr_signals, nr_samples)
+        Power-law noise, z-scored per signal.
+    """
+
+    spectrum = np.fft.rfft(rng.standard_normal((nr_signals, nr_samples)),
+                           axis=-1)
+    freq = np.fft.rfftfreq(nr_samples, 1 / sfreq)
+    exponent = np.reshape(exponent, (-1, 1))
+    scale = np.zeros((exponent.shape[0], len(freq)))
+    scale[:, 1:] = freq[1:] ** (exponent / 2)
+
+    noise = np.fft.irfft(spectrum * scale, n=nr_samples, axis=-1)
+    noise -= noise.mean(axis=-1, keepdims=True)
+    noise /= noise.std(axis=-1, keepdims=True)
+
+    return noise
+
+
+def get_montage(nr_channels):
+    """Channel names and positions of the 10-20 system, midline first."""
+
+    montage = mne.channels.make_standard_montage('standard_1020')
+    ch_names = [ch for ch in montage.ch_names if ch[-1] == 'z'] + \
+        [ch for ch in montage.ch_names if ch[-1] != 'z']
+    ch_names = ch_names[:nr_channels]
+    positions = montage.get_positions()['ch_pos']
+
+    return ch_names, np.array([positions[ch] for ch in ch_names]), montage
+
+
+def smooth_patterns(positions, nr_patterns, width, rng):
+    """Gaussian patterns centered at random channels, with random polarity.
+
+    Parameters
+    ----------
+    positions : array, shape (channels, 3)
+        Channel positions in m.
+    nr_patterns : int
+        Number of patterns.
+    width : float
+        Standard deviation of the Gaussian in m.
+    rng : instance of numpy.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    patterns : array, shape (channels, nr_patterns)
+        Patterns with unit norm.
+    """
+
+    centers = positions[rng.integers(len(positions), size=nr_patterns)]
+    distances = np.linalg.norm(positions[:, np.newaxis] - centers, axis=-1)
+    patterns = np.exp(-0.5 * (distances / width) ** 2)
+    patterns *= rng.choice([-1, 1], size=nr_patterns)
+    patterns -= patterns.mean(axis=0)
+
+    return patterns / np.linalg.norm(patterns, axis=0)
+
+
+def simulate_sources(nr_samples, sfreq, truth, simulation, rng):
+    """Time courses of the oscillatory and noise sources of one subject."""
+
+    time = np.arange(nr_samples) / sfreq
+    nr_alpha = simulation['nr_alpha']
+    nr_beta = simulation['nr_beta']
+    nr_noise = simulation['nr_noise']
+
+    # power-law noise of all sources in one batch: envelopes of the
+    # oscillations and aperiodic noise sources
+    exponents = np.r_[np.full(nr_alpha + nr_beta,
+                              simulation['envelope_exponent']),
+                      np.full(nr_noise, simulation['noise_exponent'])]
+    noise = powerlaw_noise(len(exponents), nr_samples, sfreq, exponents, rng)
+    envelopes, sources_noise = noise[:nr_alpha + nr_beta], noise[-nr_noise:]
+
+    alpha_phase = 2 * np.pi * np.outer(truth['alpha_peak'], time)
+    alpha_phase += rng.uniform(0, 2 * np.pi, (nr_alpha, 1))
+    sources_alpha = envelopes[:nr_alpha] * (
+        np.sin(alpha_phase) +
+        truth['harmonic_amplitude'][:, np.newaxis] * np.sin(2 * alpha_phase))
+
+    beta_phase = 2 * np.pi * np.outer(truth['beta_peak'], time)
+    beta_phase += rng.uniform(0, 2 * np.pi, (nr_beta, 1))
+    sources_beta = simulation['beta_amplitude'] * envelopes[nr_alpha:] * \
+        np.sin(beta_phase)
+
+    return np.concatenate((sources_alpha, sources_beta, sources_noise))
+
+
+def simulate_subject(subject, folder, seed=22, chunk_duration=10.0,
+                     **simulation):
+    """Simulate one subject and write data, header and ground truth.
+
+    Parameters
+    ----------
+    subject : str
+        Subject ID, used for the file names.
+    folder : str
+        Folder for the simulated data.
+    seed : int
+        Seed of the cohort, combined with the subject ID.
+    chunk_duration : float
+        Duration in seconds of the sensor data written at once.
+    **simulation
+        Parameters overriding SIMULATION.
+    """
+
+    simulation = {**SIMULATION, **simulation}
+    rng = np.random.default_rng([seed, zlib.crc32(subject.encode())])
+
+    def draw(name, size):
+        value = simulation[name]
+        if np.ndim(value) == 0:
+            return np.full(size, float(value))
+        return rng.uniform(*value, size=size)
+
+    nr_alpha, nr_beta = simulation['nr_alpha'], simulation['nr_beta']
+    truth = dict(alpha_peak=draw('alpha_peak', nr_alpha),
+                 harmonic_amplitude=draw('harmonic_amplitude', nr_alpha),
+                 beta_peak=draw('beta_peak', nr_beta))
+
+    sfreq = simulation['sfreq']
+    nr_samples = int(simulation['nr_seconds'] * sfreq)
+    sources = simulate_sources(nr_samples, sfreq, truth, simulation, rng)
+
+    ch_names, positions, montage = get_montage(simulation['nr_channels'])
+    nr_oscillatory = nr_alpha + nr_beta
+    patterns = np.concatenate(
+        (smooth_patterns(positions, nr_oscillatory,
+                         simulation['pattern_width'], rng),
+         rng.standard_normal((len(ch_names), simulation['nr_noise']))),
+        axis=1)
+    truth['alpha_patterns'] = patterns[:, :nr_alpha]
+    truth['beta_patterns'] = patterns[:, nr_alpha:nr_oscillatory]
+
+    # sensor data is projected and written chunk-wise to a temporary file,
+    # the header is written last and marks a complete simulation
+    os.makedirs(folder, exist_ok=True)
+    data_file, header_file, truth_file = get_simulation_files(subject, folder)
+    tmp_data_file = f"{data_file[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    data = np.lib.format.open_memmap(tmp_data_file, mode='w+',
+                                     dtype='float32',
+                                     shape=(len(ch_names), nr_samples))
+    n_chunk = int(chunk_duration * sfreq)
+    for start in range(0, nr_samples, n_chunk):
+        stop = min(start + n_chunk, nr_samples)
+        chunk = patterns @ sources[:, start:stop]
+        chunk += simulation['sensor_noise'] * rng.standard_normal(
+            chunk.shape)
+        data[:, start:stop] = 1e-6 * chunk
+    data.flush()
+    del data
+    os.replace(tmp_data_file, data_file)
+
+    np.savez(truth_file, **truth)
+
+    positions = montage.get_positions()
+    header = dict(
+        ch_names=ch_names,
+        ch_types=['eeg'] * len(ch_names),
+        sfreq=sfreq,
+        highpass=0.0,
+        lowpass=sfreq / 2,
+        montage=dict(ch_pos={ch: list(positions['ch_pos'][ch])
+                             for ch in ch_names},
+                     coord_frame=positions['coord_frame']),
+        annotations=dict(onset=[], duration=[], description=[]),
+        simulation=simulation, seed=seed)
+    with open(header_file, 'w') as f:
+        json.dump(header, f)
+
+
+def get_simulation_files(subject, folder):
+    """Return the data, header and ground-truth files of a subject."""
+
+    base_name = f"{folder}/{subject}"
+    return f"{base_name}-raw.npy", f"{base_name}-raw.json", \
+        f"{base_name}-truth.npz"
+
+
+def read_simulated(subject, folder):
+    """Return the simulated recording as RawMemmap and the ground truth."""
+
+    from raw_mmap import RawMemmap
+
+    data_file, header_file, truth_file = get_simulation_files(subject, folder)
+    with open(header_file) as f:
+        header = json.load(f)
+
+    return RawMemmap(data_file, header), dict(np.load(truth_file))
+
+
+def simulate_cohort(folder, nr_subjects, seed=22, n_jobs=N_JOBS,
+                    **simulation):
+    """Simulate subjects in parallel, see simulate_subject.
+
+    Returns
+    -------
+    subjects : list of str
+        IDs of the simulated subjects.
+    """
+
+    subjects = [f"sim-{i_subject:05d}" for i_subject in range(nr_subjects)]
+    # parameters as sorted tuples, so that the tasks are hashable
+    simulation = tuple(sorted((name, tuple(value) if np.ndim(value) else
+                               value) for name, value in simulation.items()))
+    tasks = [(subject, folder, seed, simulation) for subject in subjects]
+    _, failures = run_parallel(_simulate_task, tasks, n_jobs=n_jobs)
+    report_failures(failures)
+
+    return [subject for subject in subjects
+            if (subject, folder, seed, simulation) not in failures]
+
+
+def _simulate_task(subject, folder, seed, simulation):
+    simulate_subject(subject, folder, seed, **dict(simulation))
+
+
+def validate_subject(subject, folder):
+    """Recover the strongest alpha source with SSD and percentile spectra.
+
+    Returns
+    -------
+    result : dict
+        Absolute correlation of the first SSD pattern with the best matching
+        true alpha pattern, and the alpha peak frequency of the first SSD
+        component from its top percentile spectrum with that of the source.
+    """
+
+    import ssd
+    from helper import percentile_spectrum
+
+    raw, truth = read_simulated(subject, folder)
+
+    # SSD at the mean alpha frequency, as proc2 at the sensor alpha peak
+    peak = float(np.mean(truth['alpha_peak']))
+    filters, patterns = ssd.run_ssd(raw, peak, SSD_WIDTH)
+    corr = np.abs(np.corrcoef(patterns[:, 0],
+                              truth['alpha_patterns'].T)[0, 1:])
+    i_source = np.argmax(corr)
+
+    raw_ssd = ssd.apply_filters(raw, filters[:, :1])
+    psd_perc, freq = percentile_spectrum(raw_ssd, (ALPHA_FMIN, ALPHA_FMAX),
+                                         nr_lines=4,
+                                         nr_seconds=SPEC_NR_SECONDS)
+    idx_band = (freq >= ALPHA_FMIN) & (freq <= ALPHA_FMAX)
+    peak_ssd = freq[idx_band][np.argmax(psd_perc[0, idx_band])]
+
+    return dict(pattern_corr=corr[i_source], peak_ssd=peak_ssd,
+                peak_true=truth['alpha_peak'][i_source])
+
+
+if __name__ == "__main__":
+
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('folder')
+    parser.add_argument('--subjects', type=int, default=100)
+    parser.add_argument('--seconds', type=float,
+                        default=SIMULATION['nr_seconds'])
+    parser.add_argument('--seed', type=int, default=22)
+    parser.add_argument('--validate', action='store_true',
+                        help="recover the alpha sources with SSD")
+    args = parser.parse_args()
+
+    subjects = simulate_cohort(args.folder, args.subjects, args.seed,
+                               nr_seconds=args.seconds)
+
+    if args.validate:
+        results, failures = run_parallel(
+            validate_subject, [(subject, args.folder) for subject in subjects])
+        report_failures(failures)
+        df = pd.DataFrame.from_dict(
+            {task[0]: result for task, result in results.items()},
+            orient='index').sort_index()
+        df.to_csv(f"{args.folder}/validation.csv")
+        print(df.describe())
+        print(f"mean absolute peak error: "
+              f"{np.mean(np.abs(df.peak_ssd - df.peak_true)):.2f} Hz")
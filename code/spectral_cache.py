@@ -0,0 +1,118 @@
+""" Persistent cache for spectra and other per-subject intermediate results.
+
+Entries are npz-files in CACHE_DIR, addressed by a hash over a key (e.g.
+subject, condition, channels, n_fft, band) and the content hashes of the
+source files they were computed from, so that a changed recording is never
+served from the cache. When the cache grows beyond CACHE_MAX_GB, the least
+recently used entries are removed.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+from params import CACHE_DIR, CACHE_MAX_GB
+from helper import file_digest
+
+DIGESTS_FILE = f"{CACHE_DIR}/file_digests.json"
+
+
+def _load_digests():
+    if not os.path.exists(DIGESTS_FILE):
+        return dict()
+    try:
+        with open(DIGESTS_FILE) as f:
+            return json.load(f)
+    except ValueError:
+        return dict()
+
+
+def _save_digests(digests):
+    # written by several workers, the last one wins, which only costs a
+    # re-hash for lost entries
+    tmp_name = f"{DIGESTS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_name, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp_name, DIGESTS_FILE)
+
+
+def get_cache_file(kind, key, source_files=()):
+    """Cache file name for a key and the contents of its source files."""
+
+    digests = _load_digests()
+    known_digests = dict(digests)
+    sources = {os.path.basename(file_name): file_digest(file_name, digests)
+               for file_name in source_files}
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if digests != known_digests:
+        _save_digests(digests)
+
+    description = json.dumps(dict(kind=kind, key=key, sources=sources),
+                             sort_keys=True, default=str)
+    address = hashlib.sha256(description.encode()).hexdigest()[:24]
+
+    return f"{CACHE_DIR}/{kind}_{address}.npz"
+
+
+def evict(max_bytes=CACHE_MAX_GB * 1e9):
+    """Remove least recently used entries until the cache fits max_bytes."""
+
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npz') and '.tmp.' not in entry.name:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, file_name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def load_or_compute(kind, key, compute, source_files=()):
+    """Return cached arrays, or compute and cache them.
+
+    Parameters
+    ----------
+    kind : str
+        Type of the entry, e.g. 'psd' or 'segment_spectra'.
+    key : dict
+        Everything besides the source files that determines the result, e.g.
+        subject, condition, channels, n_fft and band.
+    compute : callable
+        Function without arguments returning a dict of arrays.
+    source_files : list of str
+        Files the result is computed from, e.g. the raw FIF.
+
+    Returns
+    -------
+    results : dict
+        Arrays as returned by compute.
+    """
+
+    file_name = get_cache_file(kind, key, source_files)
+
+    if os.path.exists(file_name):
+        try:
+            with np.load(file_name) as cached:
+                results = {name: cached[name] for name in cached.files}
+            # the modification time marks the last use for eviction
+            os.utime(file_name)
+            return results
+        except (OSError, ValueError):
+            pass
+
+    results = compute()
+
+    # write atomically, parallel workers may compute the same entry
+    tmp_name = f"{file_name[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_name, **results)
+    os.replace(tmp_name, file_name)
+    evict()
+
+    return results
@@ -9,13 +9,22 @@ doi: 10.1016/j.neuroimage.2011.01.057. Epub 2011 Jan 27. PMID: 21276858.
 
 """
 
+import os
 import numpy as np
-from scipy.linalg import eig
-import mne
-import matplotlib.pyplot as plt
+from scipy.linalg import eig, eigh
+import scipy.signal
 
+from profiling import step
 
-def compute_ged(cov_signal, cov_noise):
+# mne is only imported by the functions that need it, so that compute-only
+# worker processes start quickly; the plotting of patterns is in plotting.py
+
+# highest frequency of cross-spectra used for SSD, covers the beta-band with
+# the flanking noise bands
+CSD_FMAX = 60.0
+
+
+def compute_ged(cov_signal, cov_noise, solver="eigh", n_components=None):
     """Compute a generatlized eigenvalue decomposition maximizing principal
     directions spanned by the signal contribution while minimizing directions
     spanned by the noise contribution.
@@ -26,6 +35,12 @@ def compute_ged(cov_signal, cov_noise):
         Covariance matrix of the signal contribution.
     cov_noise : array, 2-D
         Covariance matrix of the noise contribution.
+    solver : "eigh" | "eig"
+        "eigh" uses the symmetric solver, which is faster and can compute
+        only the leading components. For rank-deficient data it falls back to
+        "eig", the general solver with dimensionality reduction.
+    n_components : int | None
+        Number of leading filters to return. If None, all filters.
 
     Returns
     -------
@@ -34,6 +49,13 @@ def compute_ged(cov_signal, cov_noise):
 
     """
 
+    if solver == "eigh":
+        filters = _compute_ged_eigh(cov_signal, cov_noise, n_components)
+        if filters is not None:
+            return filters
+    elif solver != "eig":
+        raise ValueError(f"solver must be 'eigh' or 'eig', got {solver}")
+
     nr_channels = cov_signal.shape[0]
 
     # check for rank-deficiency
@@ -60,12 +82,44 @@ def compute_ged(cov_signal, cov_noise):
     filters = filters[:, idx]
     filters = np.matmul(M, filters)
 
+    return filters[:, :n_components]
+
+
+def _compute_ged_eigh(cov_signal, cov_noise, n_components=None):
+    """Symmetric-definite solver for compute_ged.
+
+    Returns None for rank-deficient data, where the noise-regularized signal
+    covariance is not positive definite.
+    """
+
+    nr_channels = cov_signal.shape[0]
+
+    # same rank criterion as the general solver
+    lambda_val = eigh(cov_signal, eigvals_only=True)
+    tol = lambda_val[-1] * 1e-6
+    if np.sum(lambda_val > tol) < nr_channels:
+        return None
+
+    subset = None
+    if n_components is not None:
+        subset = [nr_channels - n_components, nr_channels - 1]
+
+    _, filters = eigh(cov_signal, cov_signal + cov_noise,
+                      subset_by_index=subset)
+
+    # descending order, unit norm as returned by eig
+    filters = filters[:, ::-1]
+    filters /= np.linalg.norm(filters, axis=0)
+
     return filters
 
 
-def apply_filters(raw, filters, prefix="ssd"):
+def apply_filters(raw, filters, prefix="ssd", chunk_duration=10.0):
     """Apply spatial filters on continuous data.
 
+    The components are projected chunk-wise into a new Raw instance, so
+    neither the sensor data is copied nor needs the raw to be preloaded.
+
     Parameters
     ----------
     raw : instance of Raw
@@ -75,6 +129,8 @@ def apply_filters(raw, filters, prefix="ssd"):
     prefix : string | None
         Prefix for renaming channels for disambiguation. If None: "ssd"
         is used.
+    chunk_duration : float
+        Duration in seconds of the data projected at once.
 
     Returns
     -------
@@ -82,16 +138,30 @@ def apply_filters(raw, filters, prefix="ssd"):
         Raw instance with projected signals as traces.
     """
 
-    raw_projected = raw.copy()
-    components = filters.T @ raw.get_data()
-    print(filters.shape)
     nr_components = filters.shape[1]
-    raw_projected._data = components
+    n_chunk = int(chunk_duration * raw.info["sfreq"])
+
+    # float64, the dtype of RawArray, so the buffer is used without a copy
+    components = np.empty((nr_components, raw.n_times))
+    for start in range(0, raw.n_times, n_chunk):
+        stop = min(start + n_chunk, raw.n_times)
+        np.matmul(filters.T, _get_chunk(raw, start, stop),
+                  out=components[:, start:stop])
+
+    import mne
 
     ssd_channels = [f"{prefix}{i+1}" for i in range(nr_components)]
-    mapping = dict(zip(raw.info["ch_names"], ssd_channels))
-    mne.channels.rename_channels(raw_projected.info, mapping)
-    raw_projected.drop_channels(raw_projected.info["ch_names"][nr_components:])
+    ch_types = raw.get_channel_types()[:nr_components]
+    info = mne.create_info(ssd_channels, raw.info["sfreq"], ch_types)
+    with info._unlock():
+        info["highpass"] = raw.info["highpass"]
+        info["lowpass"] = raw.info["lowpass"]
+        info["meas_date"] = raw.info["meas_date"]
+
+    raw_projected = mne.io.RawArray(components, info,
+                                    first_samp=raw.first_samp, copy=None,
+                                    verbose=False)
+    raw_projected.set_annotations(raw.annotations)
 
     return raw_projected
 
@@ -118,7 +188,7 @@ def compute_patterns(cov_signal, filters):
     return patterns
 
 
-def run_ssd(raw, peak, band_width):
+def run_ssd(raw, peak, band_width, method="iir", csd=None):
     """Wrapper for compute_ssd with standard settings for definining filters.
 
     Parameters
@@ -129,6 +199,10 @@ def run_ssd(raw, peak, band_width):
         Peak frequency of the desired signal contribution.
     band_width : float
         Spectral bandwidth for the desired signal contribution.
+    method : "iir" | "csd"
+        How the covariance matrices are computed, see compute_ssd.
+    csd : tuple | None
+        Precomputed (csd, freqs) for method="csd".
 
     Returns
     -------
@@ -138,18 +212,50 @@ def run_ssd(raw, peak, band_width):
         Spatial patterns, with each pattern being a column vector.
     """
 
+    signal_bp, noise_bp, noise_bs = get_bands(peak, band_width)
+    filters, patterns = compute_ssd(raw, signal_bp, noise_bp, noise_bs,
+                                    method=method, csd=csd)
+
+    return filters, patterns
+
+
+def get_bands(peak, band_width):
+    """Standard signal and noise bands around a peak frequency.
+
+    Parameters
+    ----------
+    peak : float
+        Peak frequency of the desired signal contribution.
+    band_width : float
+        Spectral bandwidth for the desired signal contribution.
+
+    Returns
+    -------
+    signal_bp, noise_bp, noise_bs : list
+        Pass-band for the signal, pass-band and stop-band for the noise.
+    """
+
     signal_bp = [peak - band_width, peak + band_width]
     noise_bp = [peak - (band_width + 2), peak + (band_width + 2)]
     noise_bs = [peak - (band_width + 1), peak + (band_width + 1)]
 
-    filters, patterns = compute_ssd(raw, signal_bp, noise_bp, noise_bs)
-
-    return filters, patterns
+    return signal_bp, noise_bp, noise_bs
 
 
-def compute_ssd(raw, signal_bp, noise_bp, noise_bs):
+def compute_ssd(raw, signal_bp, noise_bp, noise_bs, chunk_duration=None,
+                method="iir", csd=None):
     """Compute SSD for a specific peak frequency.
 
+    If the raw is not preloaded or a chunk duration is given, the data is
+    streamed in chunks and the covariance matrices are accumulated without
+    holding filtered copies in memory (see compute_ssd_bands).
+
+    With method="csd", no time-domain filtering is done: the covariance
+    matrices are obtained by integrating the cross-spectral density over
+    the signal and noise bands, weighted with the responses of the same IIR
+    filters. Passing a precomputed cross-spectrum (see load_or_compute_csd)
+    makes every further band a cheap integration.
+
     Parameters
     ----------
     raw : instance of Raw
@@ -160,6 +266,15 @@ def compute_ssd(raw, signal_bp, noise_bp, noise_bs):
         Pass-band for defining the noise contribution.
     noise_bs : tuple
         Stop-band for defining the noise contribution.
+    chunk_duration : float | None
+        Length of the streamed chunks in seconds. Defaults to 10 s for raws
+        that are not preloaded.
+    method : "iir" | "csd"
+        Compute covariance matrices from IIR-filtered data or from the
+        cross-spectral density.
+    csd : tuple | None
+        Precomputed (csd, freqs) as returned by compute_csd, for
+        method="csd". Computed from raw if None.
 
 
     Returns
@@ -170,46 +285,73 @@ def compute_ssd(raw, signal_bp, noise_bp, noise_bs):
         Spatial patterns, with each pattern being a column vector.
     """
 
+    if method == "csd":
+        with step("csd"):
+            if csd is None:
+                csd = compute_csd(raw, fmax=CSD_FMAX)
+            cov_signal, cov_noise = _csd_covariances(
+                *csd, raw.info["sfreq"], signal_bp, noise_bp, noise_bs)
+        with step("ged"):
+            filters = compute_ged(cov_signal, cov_noise)
+        patterns = compute_patterns(cov_signal, filters)
+        return filters, patterns
+    elif method != "iir":
+        raise ValueError(f"method must be 'iir' or 'csd', got {method}")
+
+    import mne
+
+    streaming = isinstance(raw, mne.io.BaseRaw) and \
+        (not raw.preload or chunk_duration is not None)
+    if streaming:
+        if chunk_duration is None:
+            chunk_duration = 10.0
+        bands = [(signal_bp, noise_bp, noise_bs)]
+        [(filters, patterns)] = compute_ssd_bands(raw, bands, chunk_duration)
+        return filters, patterns
+
     iir_params = dict(order=2, ftype="butter", output="sos")
 
-    # bandpass filter for signal
-    raw_signal = raw.copy().filter(
-        l_freq=signal_bp[0],
-        h_freq=signal_bp[1],
-        method="iir",
-        iir_params=iir_params,
-        verbose=False,
-    )
-
-    # bandpass filter
-    raw_noise = raw.copy().filter(
-        l_freq=noise_bp[0],
-        h_freq=noise_bp[1],
-        method="iir",
-        iir_params=iir_params,
-        verbose=False,
-    )
-
-    # bandstop filter
-    raw_noise = raw_noise.filter(
-        l_freq=noise_bs[1],
-        h_freq=noise_bs[0],
-        method="iir",
-        iir_params=iir_params,
-        verbose=False,
-    )
+    with step("filter"):
+        # bandpass filter for signal
+        raw_signal = raw.copy().filter(
+            l_freq=signal_bp[0],
+            h_freq=signal_bp[1],
+            method="iir",
+            iir_params=iir_params,
+            verbose=False,
+        )
+
+        # bandpass filter
+        raw_noise = raw.copy().filter(
+            l_freq=noise_bp[0],
+            h_freq=noise_bp[1],
+            method="iir",
+            iir_params=iir_params,
+            verbose=False,
+        )
+
+        # bandstop filter
+        raw_noise = raw_noise.filter(
+            l_freq=noise_bs[1],
+            h_freq=noise_bs[0],
+            method="iir",
+            iir_params=iir_params,
+            verbose=False,
+        )
 
     # compute covariance matrices for signal and noise contributions
-
-    if raw_signal._data.ndim == 3:
-        cov_signal = mne.compute_covariance(raw_signal, verbose=False).data
-        cov_noise = mne.compute_covariance(raw_noise, verbose=False).data
-    elif raw_signal._data.ndim == 2:
-        cov_signal = np.cov(raw_signal._data)
-        cov_noise = np.cov(raw_noise._data)
+    with step("covariance"):
+        if raw_signal._data.ndim == 3:
+            cov_signal = mne.compute_covariance(raw_signal,
+                                                verbose=False).data
+            cov_noise = mne.compute_covariance(raw_noise, verbose=False).data
+        elif raw_signal._data.ndim == 2:
+            cov_signal = np.cov(raw_signal._data)
+            cov_noise = np.cov(raw_noise._data)
 
     # compute spatial filters
-    filters = compute_ged(cov_signal, cov_noise)
+    with step("ged"):
+        filters = compute_ged(cov_signal, cov_noise)
 
     # compute spatial patterns
     patterns = compute_patterns(cov_signal, filters)
@@ -217,25 +359,355 @@ def compute_ssd(raw, signal_bp, noise_bp, noise_bs):
     return filters, patterns
 
 
-def plot_patterns(patterns, raw, nr_patterns=10):
-    """Convenience plotting function for checking spatial patterns.
+def _iir_sos(sfreq, l_freq, h_freq):
+    """Second-order sections of the IIR filter used by compute_ssd."""
+
+    import mne
+
+    iir_params = dict(order=2, ftype="butter", output="sos")
+    iir_params = mne.filter.create_filter(None, sfreq, l_freq, h_freq,
+                                          method="iir",
+                                          iir_params=iir_params,
+                                          verbose=False)
+    return iir_params["sos"]
+
+
+def _get_chunk(raw, start, stop):
+    """Read a chunk of data, from disk if the raw is not preloaded."""
+
+    if raw.preload:
+        return raw._data[:, start:stop]
+    return raw.get_data(start=start, stop=stop)
+
+
+def _filtered_covariances(raw, cascades, chunk_duration=10.0):
+    """Covariance matrices of several filtered versions of the data, computed
+    in one sweep over the data without keeping filtered copies.
+
+    The data is read and filtered chunk by chunk with the filter state
+    carried across chunk boundaries, and the sufficient statistics (sums and
+    outer products) are accumulated. Peak memory is therefore bounded by the
+    chunk size. Each filter is applied twice in forward direction: this has
+    the same magnitude response as the zero-phase (forward-backward)
+    filtering of Raw.filter, and since the same filter is applied to all
+    channels the phase does not affect the covariance.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Raw instance, if not preloaded the data is read from disk chunk-wise.
+    cascades : list of list of array
+        For each covariance, the second-order sections of the filters that
+        are applied one after the other.
+    chunk_duration : float
+        Length of the chunks in seconds.
+
+    Returns
+    -------
+    covs : list of array, 2-D
+        Covariance matrix for each filter cascade, normalized as np.cov.
+    """
+
+    nr_channels = len(raw.ch_names)
+    nr_samples = raw.n_times
+    chunk_size = int(chunk_duration * raw.info["sfreq"])
+
+    sos = [np.vstack([s for s in cascade for _ in range(2)])
+           for cascade in cascades]
+    zi = None
+    shifts = [None] * len(sos)
+    sums = [np.zeros((nr_channels,)) for _ in sos]
+    products = [np.zeros((nr_channels, nr_channels)) for _ in sos]
+
+    for start in range(0, nr_samples, chunk_size):
+        chunk = _get_chunk(raw, start, start + chunk_size)
+        if zi is None:
+            zi = [scipy.signal.sosfilt_zi(s)[:, np.newaxis, :] *
+                  chunk[np.newaxis, :, :1] for s in sos]
+
+        for i in range(len(sos)):
+            filtered, zi[i] = scipy.signal.sosfilt(sos[i], chunk, zi=zi[i])
+
+            # shifting by a rough mean estimate avoids loss of precision
+            if shifts[i] is None:
+                shifts[i] = np.mean(filtered, axis=1, keepdims=True)
+            filtered -= shifts[i]
+
+            sums[i] += np.sum(filtered, axis=1)
+            products[i] += filtered @ filtered.T
+
+    covs = [(product - np.outer(total, total) / nr_samples) /
+            (nr_samples - 1) for total, product in zip(sums, products)]
+
+    return covs
+
+
+def compute_ssd_bands(raw, bands, chunk_duration=10.0):
+    """Compute SSD for several frequency bands in one pass over the data.
+
+    All signal and noise covariance matrices are accumulated in a single
+    chunked sweep (see _filtered_covariances), so the data is neither copied
+    nor filtered as a whole once per band.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Raw instance with signals to be spatially filtered. If not preloaded,
+        the data is streamed from disk.
+    bands : list of tuple
+        (signal_bp, noise_bp, noise_bs) for each band, as in compute_ssd.
+    chunk_duration : float
+        Length of the processed chunks in seconds.
+
+    Returns
+    -------
+    results : list of tuple
+        (filters, patterns) for each band, as returned by compute_ssd.
+    """
+
+    sfreq = raw.info["sfreq"]
+    cascades = []
+    for signal_bp, noise_bp, noise_bs in bands:
+        cascades.append([_iir_sos(sfreq, signal_bp[0], signal_bp[1])])
+        cascades.append([_iir_sos(sfreq, noise_bp[0], noise_bp[1]),
+                         _iir_sos(sfreq, noise_bs[1], noise_bs[0])])
+
+    with step("filter_covariance"):
+        covs = _filtered_covariances(raw, cascades, chunk_duration)
+
+    results = []
+    for cov_signal, cov_noise in zip(covs[::2], covs[1::2]):
+        with step("ged"):
+            filters = compute_ged(cov_signal, cov_noise)
+        patterns = compute_patterns(cov_signal, filters)
+        results.append((filters, patterns))
+
+    return results
+
+
+def run_ssd_bands(raw, peaks, band_width):
+    """Wrapper for compute_ssd_bands with the standard bands of run_ssd,
+    e.g. for the alpha peak and its first harmonic: peaks=[peak, 2 * peak].
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Raw instance with signals to be spatially filtered.
+    peaks : list of float
+        Peak frequencies of the desired signal contributions.
+    band_width : float
+        Spectral bandwidth for the desired signal contributions.
+
+    Returns
+    -------
+    results : list of tuple
+        (filters, patterns) for each peak.
+    """
+
+    bands = [get_bands(peak, band_width) for peak in peaks]
+    return compute_ssd_bands(raw, bands)
+
+
+def compute_csd(raw, fmax=None, nr_seconds=4.0, block_size=16):
+    """Compute the cross-spectral density matrices of all channels with
+    Welch's method (Hann window, 50% overlap), reading the data in blocks
+    of segments.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Raw instance, if not preloaded the data is read from disk block-wise.
+    fmax : float | None
+        Highest frequency to keep. If None, up to the Nyquist frequency.
+    nr_seconds : float
+        Segment length in seconds, determines the frequency resolution.
+    block_size : int
+        Number of segments transformed at once.
+
+    Returns
+    -------
+    csd : array, 3-D
+        One-sided cross-spectral density, shape (n_freqs, n_channels,
+        n_channels).
+    freqs : array
+        Frequency axis.
+    """
+
+    sfreq = raw.info["sfreq"]
+    n_fft = int(nr_seconds * sfreq)
+    hop = n_fft // 2
+    nr_channels = len(raw.ch_names)
+    nr_segments = (raw.n_times - n_fft) // hop + 1
+
+    freqs = np.fft.rfftfreq(n_fft, 1 / sfreq)
+    if fmax is not None:
+        freqs = freqs[freqs <= fmax]
+    nr_freqs = len(freqs)
+
+    window = scipy.signal.get_window("hann", n_fft)
+    scale = np.full((nr_freqs, 1, 1), 2 / (sfreq * np.sum(window ** 2)))
+    scale[0] /= 2
+    if nr_freqs == n_fft // 2 + 1 and n_fft % 2 == 0:
+        scale[-1] /= 2
+
+    csd = np.zeros((nr_freqs, nr_channels, nr_channels), dtype=complex)
+    for i in range(0, nr_segments, block_size):
+        nr_block = min(block_size, nr_segments - i)
+        chunk = _get_chunk(raw, i * hop, (i + nr_block - 1) * hop + n_fft)
+        segments = np.lib.stride_tricks.sliding_window_view(
+            chunk, n_fft, axis=-1)[:, ::hop]
+        segments = segments - np.mean(segments, axis=-1, keepdims=True)
+        spectrum = np.fft.rfft(segments * window, axis=-1)[..., :nr_freqs]
+
+        # (freqs, channels, segments) @ (freqs, segments, channels)
+        spectrum = spectrum.transpose(2, 0, 1)
+        csd += spectrum @ spectrum.conj().transpose(0, 2, 1)
+
+    csd *= scale / nr_segments
+
+    return csd, freqs
+
+
+def _source_stamp(source_files):
+    """Size and modification time of each source file."""
+
+    stamp = []
+    for file_name in source_files:
+        stat = os.stat(file_name)
+        stamp.append([stat.st_size, stat.st_mtime_ns])
+    return np.array(stamp, dtype='int64').reshape(-1, 2)
 
-    Args:
-        patterns : array, 2-D
-            Spatial patterns.
-        raw : instance of Raw
-            Raw instance containing electrode positions.
-        nr_patterns :  int (optional)
-            Number of patterns to be plotted. Defaults to 10.
+
+def load_or_compute_csd(raw, file_name, fmax=CSD_FMAX, nr_seconds=4.0,
+                        source_files=None):
+    """Load the cross-spectral density of a recording from a cache file, or
+    compute it and store it there.
+
+    The cache is only used if the channels and parameters match and the
+    source files of the recording have the same size and modification time
+    as when the cross-spectrum was computed.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Raw instance the cross-spectrum is computed from.
+    file_name : str
+        Cache file (.npz), e.g. one per subject and condition.
+    fmax : float
+        Highest frequency to keep.
+    nr_seconds : float
+        Segment length in seconds.
+    source_files : list of str | None
+        Files the recording was read from, e.g. the raw FIF. Default: the
+        files of the Raw instance.
+
+    Returns
+    -------
+    csd : tuple
+        (csd, freqs) as returned by compute_csd.
     """
 
-    nr_cols = 4
-    nr_rows = int(np.ceil(nr_patterns/4))
+    if source_files is None:
+        source_files = [name for name in raw.filenames if name is not None]
+    source = _source_stamp(source_files)
+
+    if os.path.exists(file_name):
+        with np.load(file_name) as cached:
+            if list(cached["ch_names"]) == raw.ch_names and \
+                    cached["fmax"] == fmax and \
+                    cached["nr_seconds"] == nr_seconds and \
+                    cached["sfreq"] == raw.info["sfreq"] and \
+                    "source" in cached.files and \
+                    np.array_equal(cached["source"], source):
+                return cached["csd"], cached["freqs"]
+
+    csd, freqs = compute_csd(raw, fmax=fmax, nr_seconds=nr_seconds)
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+
+    # written atomically, the validation and proc2 share the cache
+    tmp_name = f"{file_name[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_name, csd=csd, freqs=freqs, ch_names=raw.ch_names,
+             fmax=fmax, nr_seconds=nr_seconds, sfreq=raw.info["sfreq"],
+             source=source)
+    os.replace(tmp_name, file_name)
+
+    return csd, freqs
+
+
+def _csd_covariances(csd, freqs, sfreq, signal_bp, noise_bp, noise_bs):
+    """Signal and noise covariance matrices from a cross-spectral density.
+
+    The covariance of filtered data is the integral of the cross-spectrum
+    weighted with the squared magnitude response of the filter. The weights
+    are those of the zero-phase IIR filtering in compute_ssd.
+    """
+
+    def weights(l_freq, h_freq):
+        _, response = scipy.signal.sosfreqz(_iir_sos(sfreq, l_freq, h_freq),
+                                            worN=freqs, fs=sfreq)
+        return np.abs(response) ** 4
+
+    df = freqs[1] - freqs[0]
+    weights_signal = weights(signal_bp[0], signal_bp[1])
+    weights_noise = weights(noise_bp[0], noise_bp[1]) * \
+        weights(noise_bs[1], noise_bs[0])
 
-    fig, ax = plt.subplots(nr_rows, nr_cols)
+    cov_signal = np.tensordot(weights_signal, csd.real, axes=1) * df
+    cov_noise = np.tensordot(weights_noise, csd.real, axes=1) * df
 
-    for i in range(nr_patterns):
-        ax1 = ax.flatten()[i]
-        mne.viz.plot_topomap(patterns[:, i], raw.info, axes=ax1)
+    return cov_signal, cov_noise
+
+
+def ssd_sweep(raw, peaks, band_width, nr_seconds=4.0, csd=None):
+    """Compute SSD for many candidate peak frequencies.
+
+    The cross-spectral density is computed once, the signal and noise
+    covariance matrices for each candidate are derived from it by weighting
+    with the filter responses, instead of refiltering the data.
+
+    Parameters
+    ----------
+    raw : instance of Raw
+        Raw instance with signals to be spatially filtered.
+    peaks : array
+        Candidate peak frequencies, e.g. np.arange(7, 14.01, 0.25).
+    band_width : float
+        Spectral bandwidth for the desired signal contribution.
+    nr_seconds : float
+        Segment length of the cross-spectral density estimate.
+    csd : tuple | None
+        Precomputed (csd, freqs), e.g. from load_or_compute_csd.
+
+    Returns
+    -------
+    snr : array
+        Signal-to-noise ratio of the first SSD component for each peak.
+    best_peak : float
+        Peak frequency with the highest signal-to-noise ratio.
+    filters : array, 2-D
+        Spatial filters at the best peak, each column = 1 spatial filter.
+    patterns : array, 2-D
+        Spatial patterns at the best peak.
+    """
+
+    sfreq = raw.info["sfreq"]
+    if csd is None:
+        fmax = min(2 * (np.max(peaks) + band_width + 2), sfreq / 2)
+        csd = compute_csd(raw, fmax=fmax, nr_seconds=nr_seconds)
+    csd, freqs = csd
+
+    snr = np.zeros((len(peaks),))
+    for i_peak, peak in enumerate(peaks):
+        cov_signal, cov_noise = _csd_covariances(csd, freqs, sfreq,
+                                                 *get_bands(peak, band_width))
+        w = compute_ged(cov_signal, cov_noise, n_components=1)[:, 0]
+        snr[i_peak] = (w @ cov_signal @ w) / (w @ cov_noise @ w)
+
+    best_peak = peaks[np.argmax(snr)]
+    cov_signal, cov_noise = _csd_covariances(csd, freqs, sfreq,
+                                             *get_bands(best_peak,
+                                                        band_width))
+    filters = compute_ged(cov_signal, cov_noise)
+    patterns = compute_patterns(cov_signal, filters)
 
-    fig.show()
+    return snr, best_peak, filters, patterns
@@ -0,0 +1,310 @@
+""" Vectorized statistics for the group analyses.
+
+Correlations are computed along the last axis of arrays holding many
+variables at once, e.g. subjects x channels x percentile lines, instead of
+one scipy.stats call per variable.
+
+Permutation tests draw their permutations in batches, as rows of one
+argsort of a random matrix, and evaluate the statistic for a whole batch in
+one vectorized operation. Batches are distributed over worker processes
+with parallel.run_parallel, each with its own random stream, and only the
+counts of null statistics exceeding the observed one are returned.
+
+Usage: python stats.py [--permutations N]  (tests on the results store)
+"""
+import os
+import argparse
+import tempfile
+import numpy as np
+import scipy.stats
+
+from params import FRAC_DEVIATION, N_JOBS
+from parallel import run_parallel
+
+# number of array elements evaluated at once per batch of permutations
+BATCH_ELEMENTS = 10_000_000
+
+
+def rank(x, axis=-1):
+    """Ranks along an axis, ties get their average rank."""
+
+    return scipy.stats.rankdata(x, axis=axis)
+
+
+def pearson(x, y, axis=-1):
+    """Pearson correlation along an axis, broadcast over the other axes."""
+
+    x = x - np.mean(x, axis=axis, keepdims=True)
+    y = y - np.mean(y, axis=axis, keepdims=True)
+    return np.sum(x * y, axis=axis) / np.sqrt(
+        np.sum(x ** 2, axis=axis) * np.sum(y ** 2, axis=axis))
+
+
+def spearman(x, y, axis=-1):
+    """Spearman correlation along an axis, as scipy.stats.spearmanr.
+
+    Parameters
+    ----------
+    x, y : array
+        Observations along [axis], any shape of the other axes.
+    axis : int
+        Axis of the observations.
+
+    Returns
+    -------
+    corr : array
+        Correlation coefficients, shape of x without [axis].
+    p : array
+        Two-sided p-values from the t-distribution with n - 2 degrees of
+        freedom.
+    """
+
+    corr = pearson(rank(x, axis), rank(y, axis), axis)
+
+    dof = x.shape[axis] - 2
+    with np.errstate(divide='ignore'):
+        t = corr * np.sqrt(dof / ((1 - corr) * (1 + corr)))
+    p = 2 * scipy.stats.t.sf(np.abs(t), dof)
+
+    return corr, p
+
+
+def _permutations(rng, nr_permutations, n):
+    """Random permutations of n elements as rows, from one batched argsort."""
+
+    return np.argsort(rng.random((nr_permutations, n)), axis=1)
+
+
+def _standardized_ranks(x):
+    """Ranks along the last axis with zero mean and unit norm."""
+
+    ranks = rank(x)
+    ranks -= ranks.mean(axis=-1, keepdims=True)
+    return ranks / np.sqrt(np.sum(ranks ** 2, axis=-1, keepdims=True))
+
+
+def _null_spearman(data, rng, nr_permutations):
+    # with standardized ranks, the correlation is a dot product
+    perms = _permutations(rng, nr_permutations, data['x'].shape[-1])
+    null = np.einsum('...n,...pn->p...', data['x'], data['y'][..., perms])
+    return np.sum(np.abs(null) >= np.abs(data['observed']) - 1e-12, axis=0)
+
+
+def _null_harmonic_fraction(data, rng, nr_permutations):
+    # beta peaks paired with the alpha peaks of other subjects
+    perms = _permutations(rng, nr_permutations, len(data['alpha']))
+    null = _harmonic_fraction(data['alpha'], data['beta'][perms],
+                              data['deviation'])
+    return np.sum(null >= data['observed'] - 1e-12)
+
+
+def _null_sign_flip(data, rng, nr_permutations):
+    values = data['values']
+    signs = rng.choice([-1.0, 1.0], size=(nr_permutations, len(values)))
+    null = np.abs(signs @ values.reshape(len(values), -1)) / len(values)
+    observed = np.abs(data['observed']).reshape(1, -1) - 1e-12
+    # uncorrected and corrected by the maximum over all variables
+    count = np.sum(null >= observed, axis=0)
+    count_max = np.sum(null.max(axis=1, keepdims=True) >= observed, axis=0)
+    return np.array([count, count_max]).reshape(
+        (2,) + data['observed'].shape)
+
+
+_NULL_STATISTICS = dict(spearman=_null_spearman,
+                        harmonic_fraction=_null_harmonic_fraction,
+                        sign_flip=_null_sign_flip)
+
+
+def _run_batch(kind, data_file, nr_permutations, seed, i_batch):
+    """Exceedance counts of one batch of permutations."""
+
+    data = dict(np.load(data_file))
+    rng = np.random.default_rng([seed, i_batch])
+    return _NULL_STATISTICS[kind](data, rng, nr_permutations)
+
+
+def _permutation_counts(kind, data, nr_permutations, seed, n_jobs,
+                        nr_elements):
+    """Sum the exceedance counts over batches computed in parallel.
+
+    The data is passed to the workers as a temporary npz-file, so that the
+    tasks only hold the file name.
+    """
+
+    batch_size = int(np.clip(BATCH_ELEMENTS // max(nr_elements, 1), 1,
+                             nr_permutations))
+    batches = [min(batch_size, nr_permutations - start)
+               for start in range(0, nr_permutations, batch_size)]
+
+    file_handle, data_file = tempfile.mkstemp(suffix='.npz')
+    os.close(file_handle)
+    try:
+        np.savez(data_file, **data)
+        tasks = [(kind, data_file, nr_batch, seed, i_batch)
+                 for i_batch, nr_batch in enumerate(batches)]
+        n_jobs = 1 if len(tasks) == 1 else n_jobs
+        results, failures = run_parallel(_run_batch, tasks, n_jobs=n_jobs,
+                                         timeout=None, verbose=False)
+    finally:
+        os.remove(data_file)
+
+    if failures:
+        raise RuntimeError(next(iter(failures.values())))
+    return sum(results.values())
+
+
+def spearman_permutation(x, y, nr_permutations=10000, seed=22,
+                         n_jobs=N_JOBS):
+    """Spearman correlation with permutation p-values, for many pairs.
+
+    Parameters
+    ----------
+    x, y : array, shape (..., n)
+        Observations along the last axis, any shape of the other axes.
+    nr_permutations : int
+        Number of permutations of y.
+    seed : int
+        Seed of the random permutations.
+    n_jobs : int
+        Number of worker processes, see parallel.run_parallel.
+
+    Returns
+    -------
+    corr : array, shape (...)
+        Correlation coefficients.
+    p : array, shape (...)
+        Two-sided permutation p-values.
+    """
+
+    x_ranks = _standardized_ranks(np.asarray(x, dtype=float))
+    y_ranks = _standardized_ranks(np.asarray(y, dtype=float))
+    corr = np.sum(x_ranks * y_ranks, axis=-1)
+
+    data = dict(x=x_ranks, y=y_ranks, observed=corr)
+    count = _permutation_counts('spearman', data, nr_permutations, seed,
+                                n_jobs, x_ranks.size)
+
+    return corr, (count + 1) / (nr_permutations + 1)
+
+
+def _harmonic_fraction(alpha_peak, beta_peak, deviation):
+    fraction = beta_peak / alpha_peak
+    close = (fraction < 2 + deviation) & (fraction > 2 - deviation)
+    return np.mean(close, axis=-1)
+
+
+def harmonic_fraction_test(alpha_peak, beta_peak, deviation=FRAC_DEVIATION,
+                           nr_permutations=10000, seed=22, n_jobs=N_JOBS):
+    """Test whether more beta peaks are at twice the alpha peak than chance.
+
+    The statistic is the fraction of subjects with a ratio of beta and
+    alpha peak frequency within 2 +- deviation, as in fig3b. Under the null
+    hypothesis, beta peaks are unrelated to the alpha peak of the same
+    subject, which is simulated by pairing the peaks of different subjects.
+
+    Parameters
+    ----------
+    alpha_peak, beta_peak : array, shape (subjects,)
+        Peak frequencies per subject.
+    deviation : float
+        Allowed deviation of the ratio from 2.
+    nr_permutations : int
+        Number of permutations of the beta peaks across subjects.
+    seed : int
+        Seed of the random permutations.
+    n_jobs : int
+        Number of worker processes, see parallel.run_parallel.
+
+    Returns
+    -------
+    fraction : float
+        Fraction of subjects with harmonic beta peak.
+    p : float
+        One-sided permutation p-value.
+    """
+
+    alpha_peak = np.asarray(alpha_peak, dtype=float)
+    beta_peak = np.asarray(beta_peak, dtype=float)
+    fraction = _harmonic_fraction(alpha_peak, beta_peak, deviation)
+
+    data = dict(alpha=alpha_peak, beta=beta_peak, deviation=deviation,
+                observed=fraction)
+    count = _permutation_counts('harmonic_fraction', data, nr_permutations,
+                                seed, n_jobs, alpha_peak.size)
+
+    return fraction, (count + 1) / (nr_permutations + 1)
+
+
+def sign_flip_test(values, nr_permutations=10000, seed=22, n_jobs=N_JOBS):
+    """Test whether the mean over subjects differs from zero, per variable.
+
+    Signs of the values of each subject are flipped at random, e.g. for the
+    alpha-beta correlations of all channels (subjects x channels).
+
+    Parameters
+    ----------
+    values : array, shape (subjects, ...)
+        Values per subject, without missing values.
+    nr_permutations : int
+        Number of random sign flips.
+    seed : int
+        Seed of the random sign flips.
+    n_jobs : int
+        Number of worker processes, see parallel.run_parallel.
+
+    Returns
+    -------
+    mean : array, shape (...)
+        Mean over subjects.
+    p : array, shape (...)
+        Two-sided p-values.
+    p_max : array, shape (...)
+        Two-sided p-values corrected for multiple comparisons with the
+        maximum statistic over all variables.
+    """
+
+    values = np.asarray(values, dtype=float)
+    mean = values.mean(axis=0)
+
+    data = dict(values=values, observed=mean)
+    count, count_max = _permutation_counts('sign_flip', data,
+                                           nr_permutations, seed, n_jobs,
+                                           values.size)
+
+    return mean, (count + 1) / (nr_permutations + 1), \
+        (count_max + 1) / (nr_permutations + 1)
+
+
+if __name__ == "__main__":
+
+    import pandas as pd
+    import results_store
+    from params import CSV_DIR
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--permutations', type=int, default=10000)
+    args = parser.parse_args()
+
+    for condition in ['ec', 'eo']:
+        df = results_store.read_table('ssd_param', condition).dropna()
+        print(f"{condition}: N={len(df)}")
+
+        fraction, p = harmonic_fraction_test(
+            df.alpha_peak, df.beta_peak, nr_permutations=args.permutations)
+        print(f"  harmonic beta peak: {100 * fraction:.1f}% of subjects, "
+              f"p={p:.4f}")
+
+        corr, p = spearman_permutation(df.alpha_peak, df.beta_peak,
+                                       args.permutations)
+        print(f"  alpha-beta peak frequency: Spearman r={corr:.3f}, "
+              f"p={p:.4f}")
+
+        coupling_file = f'{CSV_DIR}/sensor_coupling_{condition}.csv'
+        if os.path.exists(coupling_file):
+            coupling = pd.read_csv(coupling_file, index_col=0).dropna(axis=1)
+            # Fisher z-transform of the correlations per subject
+            values = np.arctanh(np.clip(coupling.values, -0.999, 0.999))
+            mean, p, p_max = sign_flip_test(values, args.permutations)
+            print(f"  alpha-beta power coupling, channels with corrected "
+                  f"p<0.05: {int(np.sum(p_max < 0.05))} of "
+                  f"{len(coupling.columns)}")
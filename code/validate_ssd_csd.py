@@ -0,0 +1,52 @@
+# %%
+""" Validation: compare SSD computed from the cross-spectral density with
+SSD computed from IIR-filtered data, for the alpha peak and its harmonic."""
+import mne
+import numpy as np
+import pandas as pd
+import ssd
+import results_store
+from helper import get_participant_list
+from params import DATA_DIR, CSD_DIR, SSD_WIDTH
+
+mne.set_log_level(verbose=False)
+
+condition = 'eo'
+nr_subjects = 10
+nr_components = 2
+
+# %% compute SSD with both methods
+results = []
+subjects = get_participant_list('sensor_param', condition)[:nr_subjects]
+for subject in subjects:
+
+    sensor_param = results_store.read_row('sensor_param', subject,
+                                          condition)
+    peak_alpha = np.float32(sensor_param['peak_frequency'])
+    if np.isnan(peak_alpha):
+        continue
+
+    file_name = f"{DATA_DIR}/{subject}_{condition}-raw.fif"
+    raw = mne.io.read_raw_fif(file_name, preload=True)
+    raw.pick_types(eeg=True)
+    csd = ssd.load_or_compute_csd(
+        raw, f"{CSD_DIR}/{subject}_{condition}-csd.npz",
+        source_files=[file_name])
+
+    # both IIR decompositions from one pass over the data
+    peaks = {'alpha': peak_alpha, 'beta': 2 * peak_alpha}
+    results_iir = ssd.run_ssd_bands(raw, list(peaks.values()), SSD_WIDTH)
+
+    for (band, peak), (_, patterns_iir) in zip(peaks.items(), results_iir):
+        _, patterns_csd = ssd.run_ssd(raw, peak, SSD_WIDTH, method='csd',
+                                      csd=csd)
+        for i_comp in range(nr_components):
+            corr = np.corrcoef(patterns_iir[:, i_comp],
+                               patterns_csd[:, i_comp])[0, 1]
+            results.append(dict(subject=subject, band=band,
+                                component=i_comp + 1,
+                                pattern_corr=np.abs(corr)))
+
+# %% summary: absolute correlation of spatial patterns between methods
+df_results = pd.DataFrame(results)
+print(df_results.groupby(['band', 'component']).pattern_corr.describe())